@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+# Micro-benchmark of the advertisement decoder: the original dict-building
+# parser (kept below for reference) vs. the struct-based decode_payload().
+#
+#   python3 benchmark/bench_decoder.py
+
+import os
+import sys
+import timeit
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sensor_collector
+
+legacy_frame_count_dict = {}
+
+
+def legacy_parse_custom_payload(data, advertisement_data):
+
+    if len(data) < 13:
+        return None
+
+    ts = datetime.now()
+
+    mac = ":".join(f"{b:02X}" for b in data[0:6])
+    temp_raw = int.from_bytes(data[6:8], byteorder="big", signed=True)
+    humidity = data[8]
+    battery = data[9]
+    voltage_raw = int.from_bytes(data[10:12], byteorder="big")
+    frame_counter = data[12]
+
+    temp = temp_raw / 10.0
+    voltage = voltage_raw / 1000.0
+
+    rssi = advertisement_data.rssi
+    distance = sensor_collector.estimate_distance(rssi)
+
+    measured_interval = 0
+    last_frame_data = legacy_frame_count_dict.get(mac, None)
+    if last_frame_data:
+        last_ts = last_frame_data["ts"]
+        last_frame_counter = last_frame_data["frame_counter"]
+        measured_interval = last_frame_data["measured_interval"]
+        if last_frame_counter != frame_counter:
+            measured_interval = (ts - last_ts).total_seconds()
+            legacy_frame_count_dict[mac] = {
+                "ts": ts,
+                "frame_counter": frame_counter,
+                "measured_interval": measured_interval
+            }
+    else:
+        legacy_frame_count_dict[mac] = {
+            "ts": ts,
+            "frame_counter": frame_counter,
+            "measured_interval": measured_interval
+        }
+
+    entry = {
+        "timestamp": ts.strftime("%Y-%m-%d %H:%M:%S"),
+        "temperature": round(temp, 2),
+        "humidity": int(humidity),
+        "battery_level": float(battery),
+        "battery_voltage": round(voltage, 3),
+        "frame_counter": int(frame_counter),
+        "rssi": int(rssi),
+        "distance": round(distance, 2) or 0.0,
+        "measurement_interval": round(float(measured_interval), 2)
+    }
+
+    entry.update(sensor_collector.registry.lookup(int(mac.replace(":", ""), 16)) or {})
+
+    return entry
+
+
+def make_payload(mac_address, temperature=21.5, humidity=47, battery=90, voltage=3.012, frame_counter=157):
+
+    return (bytes.fromhex(mac_address.replace(":", "")) +
+            int(temperature * 10).to_bytes(2, "big", signed=True) +
+            bytes([humidity, battery]) +
+            int(voltage * 1000).to_bytes(2, "big") +
+            bytes([frame_counter]))
+
+
+def bench(name, func, number, frames_per_call=1):
+
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    frames = number * frames_per_call
+    per_frame_us = seconds / frames * 1e6
+    print(f"{name:<40} {per_frame_us:8.2f} us/frame  {frames / seconds:12,.0f} frames/s")
+    return per_frame_us
+
+
+if __name__ == "__main__":
+
+    payload = make_payload("A4:C1:38:AA:EA:0D")
+    advertisement_data = SimpleNamespace(rssi=-72)
+    number = 100_000
+
+    before = bench("legacy parse_custom_payload (dict)", lambda: legacy_parse_custom_payload(payload, advertisement_data), number)
+    after = bench("decode_payload (SensorReading)", lambda: sensor_collector.decode_payload(payload, -72), number)
+    bench("decode_payload + to_dict", lambda: sensor_collector.decode_payload(payload, -72).to_dict(), number)
+
+    print(f"\ndecode speed-up: {before / after:.1f}x\n")
+
+    # one day of frames from 1000 sensors reporting once a minute
+    batch = payload * (1000 * 24 * 60)
+    batch_rssi = [-72] * (1000 * 24 * 60)
+    bench("parse_custom_payloads (NumPy, 1.44M)", lambda: sensor_collector.parse_custom_payloads(batch, batch_rssi), 1, len(batch_rssi))
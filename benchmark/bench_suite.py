@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+# End-to-end benchmark of the collector hot path. Reports ops/sec and p50/p99
+# latency per stage, and the throughput of the whole collector replaying
+# synthetic traffic against a local fake InfluxDB (benchmark/fake_influxdb.py)
+# and an in-memory Redis (fakeredis, if installed; else a local Redis server).
+#
+#   python3 benchmark/bench_suite.py --save benchmark/baselines/$(git describe --always).json
+#   python3 benchmark/bench_suite.py --compare benchmark/baselines/<previous>.json
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import datetime
+import tempfile
+import contextlib
+import functools
+import subprocess
+from types import SimpleNamespace
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sensor_collector
+import sensor_collect_forward
+from frame_dedup import FrameDedup, AsyncRedisDedup
+from influxdb_access import InfluxDB_Access
+from influxdb_writer import InfluxDB_Writer
+from ble_capture import CaptureWriter, ReplayScanner
+from influxdb_client.client.write.point import Point
+from fake_influxdb import FakeInfluxDB
+
+
+def percentile(sorted_values, pct):
+
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies_ns, elapsed_s, ops=None):
+
+    latencies_ns.sort()
+    ops = len(latencies_ns) if ops is None else ops
+
+    return {
+        "ops": ops,
+        "ops_per_sec": round(ops / elapsed_s, 1) if elapsed_s else 0.0,
+        "p50_us": round(percentile(latencies_ns, 50) / 1000, 3),
+        "p99_us": round(percentile(latencies_ns, 99) / 1000, 3)
+    }
+
+
+def run_sync(func, inputs):
+
+    latencies = []
+    clock = time.perf_counter_ns
+
+    start = clock()
+    for item in inputs:
+        t0 = clock()
+        func(item)
+        latencies.append(clock() - t0)
+    elapsed = (clock() - start) / 1e9
+
+    return summarize(latencies, elapsed)
+
+
+async def run_async(func, inputs):
+
+    latencies = []
+    clock = time.perf_counter_ns
+
+    start = clock()
+    for item in inputs:
+        t0 = clock()
+        await func(item)
+        latencies.append(clock() - t0)
+    elapsed = (clock() - start) / 1e9
+
+    return summarize(latencies, elapsed)
+
+
+async def run_async_concurrent(func, inputs, concurrency):
+    """
+        Like run_async(), with up to 'concurrency' calls in flight (as with several consumers).
+    """
+
+    latencies = []
+    clock = time.perf_counter_ns
+
+    async def timed(item):
+        t0 = clock()
+        await func(item)
+        latencies.append(clock() - t0)
+
+    start = clock()
+    for i in range(0, len(inputs), concurrency):
+        await asyncio.gather(*(timed(item) for item in inputs[i:i + concurrency]))
+    elapsed = (clock() - start) / 1e9
+
+    return summarize(latencies, elapsed)
+
+
+def make_redis_factory():
+    """
+        Returns (factory, kind): the factory creates an async Redis client for the
+        running event loop, backed by an in-memory Redis if fakeredis is available,
+        else by a local Redis server (db 15). factory is None if neither is usable.
+    """
+
+    try:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        return functools.partial(fakeredis.FakeAsyncRedis, server=server), "fakeredis"
+    except ImportError:
+        pass
+
+    import redis.asyncio
+    factory = functools.partial(redis.asyncio.Redis, host="localhost", port=6379, db=15)
+
+    async def ping():
+        await factory().ping()
+
+    try:
+        asyncio.run(ping())
+    except Exception:
+        return None, "unavailable"
+
+    return factory, "localhost"
+
+
+@contextlib.contextmanager
+def raw_forwarding():
+    """
+        Forward one raw point per reading (no deadband suppression, no rollups),
+        so every reading exercises the write path.
+    """
+
+    saved = (sensor_collect_forward.forward_raw, sensor_collect_forward.deadband, sensor_collect_forward.edge_rollup)
+    sensor_collect_forward.forward_raw = True
+    sensor_collect_forward.deadband = None
+    sensor_collect_forward.edge_rollup = None
+
+    try:
+        yield
+    finally:
+        sensor_collect_forward.forward_raw, sensor_collect_forward.deadband, sensor_collect_forward.edge_rollup = saved
+
+
+def make_traffic(sensors, frames_per_sensor, repeats):
+    """
+        Synthetic advertisements: every sensor sends 'frames_per_sensor' frames,
+        each re-advertised 'repeats' times, interleaved across sensors.
+    """
+
+    rng = random.Random(42)
+    traffic = []
+
+    for frame in range(frames_per_sensor):
+        for _ in range(repeats):
+            for index in range(sensors):
+                mac_raw = (0xA4C138000000 + index).to_bytes(6, "big")
+                address = ":".join(f"{b:02X}" for b in mac_raw)
+                payload = sensor_collector.PAYLOAD_STRUCT.pack(mac_raw, 215 + index % 50, 47, 90, 3012, frame & 0xFF)
+                traffic.append((address, rng.randint(-95, -50), payload))
+
+    sensor_collector.register_sensors([
+        {"name": f"bench{index}", "location": "bench", "mac_address": address}
+        for index, address in enumerate(sorted({address for address, _, _ in traffic}))
+    ])
+
+    return traffic
+
+#############
+
+def bench_stages(args, redis_factory):
+
+    results = {}
+
+    traffic = make_traffic(args.sensors, 4, args.repeats)
+    frames = [(payload, SimpleNamespace(rssi=rssi)) for _, rssi, payload in traffic]
+
+    results["parse_custom_payload"] = run_sync(lambda f: sensor_collector.parse_custom_payload(*f), frames)
+    results["decode_payload"] = run_sync(lambda f: sensor_collector.decode_payload(f[0], f[1].rssi), frames)
+    results["estimate_distance"] = run_sync(sensor_collector.estimate_distance, [rssi for _, rssi, _ in traffic])
+
+    readings = [sensor_collector.decode_payload(f[0], f[1].rssi) for f in frames]
+
+    # dedup: mostly repeats, as on a live collector
+    sensor_collect_forward.frame_dedup = FrameDedup()
+    sensor_collect_forward.redis_dedup = None
+    results["is_duplicate (local)"] = asyncio.run(run_async(sensor_collect_forward.is_duplicate, readings))
+
+    if redis_factory:
+
+        async def with_redis():
+            redis_h = redis_factory()
+            sensor_collect_forward.frame_dedup = FrameDedup(ttl_seconds=0)  # every check goes to Redis
+            sensor_collect_forward.redis_dedup = AsyncRedisDedup(redis_h, collector_id="bench")
+            await redis_h.flushdb()
+            return await run_async_concurrent(sensor_collect_forward.is_duplicate, readings, args.consumers)
+
+        results["is_duplicate (redis)"] = asyncio.run(with_redis())
+
+    # forward_influxdb up to line protocol, whatever shape the writer is handed
+    points = []
+    sensor_collect_forward.influx_writer = SimpleNamespace(write=points.append)
+
+    def forward(reading):
+        sensor_collect_forward.forward_influxdb(reading)
+        point = points.pop()
+        if not isinstance(point, str):
+            point = Point.from_dict(point).to_line_protocol()
+        return point
+
+    with raw_forwarding():
+        results["forward_influxdb -> line protocol"] = run_sync(forward, readings)
+
+    return results
+
+
+def bench_collector(args, redis_factory):
+    """
+        Replay synthetic traffic at full speed through scan() + handle_sensor_data,
+        writing to the fake InfluxDB. Latency is reception -> forwarded.
+    """
+
+    fake_influxdb = FakeInfluxDB().start()
+    url, port = fake_influxdb.url
+
+    traffic = make_traffic(args.sensors, args.frames, args.repeats)
+    readings_expected = args.sensors * args.frames
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        capture_path = os.path.join(tmp_dir, "traffic.cap")
+        capture = CaptureWriter(capture_path)
+        for ts, (address, rssi, payload) in enumerate(traffic):
+            capture.record(address, rssi, sensor_collector.UUID_ENV_SENSING, payload, ts_ns=ts)
+        capture.close()
+
+        sensor_collect_forward.frame_dedup = FrameDedup()
+
+        write_fn = functools.partial(InfluxDB_Access.write_points, url=url, port=port)
+        writer = InfluxDB_Writer(write_fn=write_fn, batch_size=500, flush_interval=1.0)
+        sensor_collect_forward.influx_writer = writer
+
+        latencies = []
+
+        def measure(reading):
+            latencies.append(time.time_ns() - reading.ts_ns)
+
+        sensor_collector._data_callbacks.clear()
+        sensor_collector.register_callback(sensor_collect_forward.handle_sensor_data, raw=True)
+        sensor_collector.register_callback(measure, blocking=False, raw=True)
+
+        async def run():
+            sensor_collect_forward.redis_dedup = None
+            if redis_factory:
+                redis_h = redis_factory()
+                await redis_h.flushdb()
+                sensor_collect_forward.redis_dedup = AsyncRedisDedup(redis_h, collector_id="bench")
+
+            holder = {}
+            scanner_ready = asyncio.Event()
+
+            def make_scanner(detection_callback):
+                holder["scanner"] = ReplayScanner(detection_callback, capture_path, speed=None)
+                scanner_ready.set()
+                return holder["scanner"]
+
+            task = asyncio.create_task(sensor_collector.scan(queue_size=args.queue_size,
+                                                             consumers=args.consumers,
+                                                             scanner_cls=make_scanner))
+            await scanner_ready.wait()
+
+            start = time.perf_counter()
+            await holder["scanner"].finished.wait()
+
+            # drain: wait until the consumers processed every queued frame
+            await sensor_collector._frame_queue.join()
+            elapsed = time.perf_counter() - start
+
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return elapsed
+
+        writer.start()
+        with contextlib.redirect_stdout(io.StringIO()), raw_forwarding():
+            elapsed = asyncio.run(run())
+        writer.stop()
+
+    fake_influxdb.stop()
+
+    result = summarize(latencies, elapsed, ops=len(traffic))
+    result["advertisements"] = len(traffic)
+    result["readings"] = len(latencies)
+    result["readings_expected"] = readings_expected
+    result["points_written"] = fake_influxdb.stats["points"]
+    result["write_requests"] = fake_influxdb.stats["write_requests"]
+
+    return {"collector (replay -> fake influxdb)": result}
+
+#############
+
+def git_revision():
+
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path, threshold):
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)["stages"]
+
+    rows = []
+    regressions = 0
+
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        before = baseline[stage]["ops_per_sec"]
+        after = result["ops_per_sec"]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change < -threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        rows.append([stage, before, after, f"{change:+.1%}", flag])
+
+    print(f"\nCompared with {baseline_path}:")
+    print(tabulate(rows, headers=["Stage", "Baseline ops/s", "Current ops/s", "Change", ""], tablefmt="grid"))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the collector hot path.")
+    parser.add_argument("--sensors", type=int, default=500, help="number of synthetic sensors")
+    parser.add_argument("--frames", type=int, default=10, help="measurements per sensor (collector run)")
+    parser.add_argument("--repeats", type=int, default=20, help="advertisements per measurement")
+    parser.add_argument("--queue-size", type=int, default=4096, help="frame queue size (collector run)")
+    parser.add_argument("--consumers", type=int, default=8, help="frame queue consumer tasks (collector run)")
+    parser.add_argument("--save", metavar="FILE", help="store results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="ops/sec drop reported as a regression")
+    args = parser.parse_args()
+
+    redis_factory, redis_kind = make_redis_factory()
+
+    results = bench_stages(args, redis_factory)
+    results.update(bench_collector(args, redis_factory))
+
+    rows = [[stage, r["ops"], r["ops_per_sec"], r["p50_us"], r["p99_us"]] for stage, r in results.items()]
+    print(tabulate(rows, headers=["Stage", "Ops", "Ops/s", "p50 (us)", "p99 (us)"], tablefmt="grid"))
+
+    collector = results["collector (replay -> fake influxdb)"]
+    print(f"\ncollector: {collector['readings']}/{collector['readings_expected']} readings, "
+          f"{collector['points_written']} points in {collector['write_requests']} write requests, redis: {redis_kind}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "revision": git_revision(),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "node": platform.node(),
+                    "redis": redis_kind,
+                    "args": vars(args)
+                },
+                "stages": results
+            }, f, indent=4)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare:
+        if compare(results, args.compare, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+# Minimal local stand-in for the InfluxDB v2 HTTP API, good enough for the
+# collector's write path: bucket lookup/creation and /api/v2/write.
+
+import json
+import gzip
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeInfluxDB():
+
+    def __init__(self, host="127.0.0.1", port=0, write_delay=0.0):
+
+        self.buckets = {"home_sensors"}
+        self.write_delay = write_delay
+        self.lock = threading.Lock()
+        self.lines = []
+
+        self.stats = {
+            "write_requests": 0,
+            "points": 0,
+            "bytes": 0
+        }
+
+        self.server = ThreadingHTTPServer((host, port), self.__make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+
+    @property
+    def url(self):
+
+        host, port = self.server.server_address[:2]
+        return f"http://{host}", port
+
+
+    def start(self):
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-influxdb", daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def __make_handler(self):
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code, body=None):
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def read_body(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return body
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/api/v2/buckets":
+                    names = parse_qs(url.query).get("name", None)
+                    buckets = [name for name in sorted(fake.buckets) if not names or name in names]
+                    self.reply(200, {"buckets": [{"id": name, "name": name, "retentionRules": []} for name in buckets]})
+                elif url.path in ("/ping", "/health"):
+                    self.reply(200, {"status": "pass"})
+                else:
+                    self.reply(404, {"message": "not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.read_body()
+                if url.path == "/api/v2/write":
+                    if fake.write_delay:
+                        threading.Event().wait(fake.write_delay)
+                    lines = [line for line in body.decode().split("\n") if line]
+                    with fake.lock:
+                        fake.lines.extend(lines)
+                        fake.stats["write_requests"] += 1
+                        fake.stats["points"] += len(lines)
+                        fake.stats["bytes"] += len(body)
+                    self.reply(204)
+                elif url.path == "/api/v2/buckets":
+                    name = json.loads(body).get("name")
+                    fake.buckets.add(name)
+                    self.reply(201, {"id": name, "name": name, "retentionRules": []})
+                else:
+                    self.reply(404, {"message": "not found"})
+
+        return Handler
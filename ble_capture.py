@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import os
+import mmap
+import time
+import uuid
+import struct
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+# file header: magic + format version
+CAPTURE_MAGIC = b"EWCAP"
+CAPTURE_VERSION = 1
+HEADER_STRUCT = struct.Struct("<5sB")
+
+# record header: monotonic timestamp (ns), MAC, RSSI, service UUID, payload length
+RECORD_STRUCT = struct.Struct("<Q6sb16sB")
+
+# replay gap between the last frame of a capture and the first frame appended to it
+SESSION_GAP_NS = 1_000_000_000
+
+
+class CaptureWriter():
+    """
+        Appends raw advertisement frames, as delivered by BleakScanner, to a
+        compact binary capture file (32 bytes + payload per frame).
+
+        Monotonic timestamps of different sessions (or boots) are unrelated, so
+        when appending to an existing capture the timestamps of this session are
+        re-based to continue SESSION_GAP_NS after its last frame.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.frames = 0
+
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+
+        # raises ValueError if 'path' is not a capture file, rather than appending to it
+        self.last_ts = None if new_file else self.__last_timestamp(path)
+        self.ts_offset = None
+
+        self.f = open(path, "ab", buffering=64 * 1024)
+        if new_file:
+            self.f.write(HEADER_STRUCT.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+
+
+    def close(self):
+
+        self.f.close()
+
+
+    def record(self, address, rssi, service_uuid, payload, ts_ns=None):
+
+        if ts_ns is None:
+            ts_ns = time.monotonic_ns()
+
+        try:
+            mac = bytes.fromhex(address.replace(":", ""))
+        except ValueError:
+            return  # not a MAC address (e.g., macOS device UUIDs)
+
+        if self.ts_offset is None:
+            self.ts_offset = 0 if self.last_ts is None else self.last_ts + SESSION_GAP_NS - ts_ns
+        ts_ns += self.ts_offset
+
+        self.f.write(RECORD_STRUCT.pack(ts_ns, mac, rssi, uuid.UUID(service_uuid).bytes, len(payload)))
+        self.f.write(payload)
+        self.frames += 1
+
+
+    @staticmethod
+    def __last_timestamp(path):
+
+        last_ts = None
+        for ts_ns, *_ in read_capture(path):
+            last_ts = ts_ns
+        return last_ts
+
+
+def read_capture(path):
+    """
+        Memory-map a capture file and yield (ts_ns, address, rssi, service_uuid, payload)
+        for every recorded frame.
+    """
+
+    with open(path, "rb") as f:
+
+        if os.fstat(f.fileno()).st_size < HEADER_STRUCT.size:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+            magic, version = HEADER_STRUCT.unpack_from(mm, 0)
+            if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+                raise ValueError(f"{path}: not a capture file (version {CAPTURE_VERSION})")
+
+            addresses = {}
+            uuids = {}
+            offset = HEADER_STRUCT.size
+            end = len(mm)
+
+            while offset + RECORD_STRUCT.size <= end:
+
+                ts_ns, mac, rssi, uuid_raw, length = RECORD_STRUCT.unpack_from(mm, offset)
+                offset += RECORD_STRUCT.size
+
+                if offset + length > end:
+                    break  # truncated last frame (capture was interrupted)
+
+                address = addresses.get(mac, None)
+                if address is None:
+                    address = addresses[mac] = ":".join(f"{b:02X}" for b in mac)
+
+                service_uuid = uuids.get(uuid_raw, None)
+                if service_uuid is None:
+                    service_uuid = uuids[uuid_raw] = str(uuid.UUID(bytes=uuid_raw))
+
+                yield ts_ns, address, rssi, service_uuid, mm[offset:offset + length]
+                offset += length
+
+
+class ReplayDevice():
+
+    __slots__ = ("address",)
+
+    def __init__(self, address):
+        self.address = address
+
+
+class ReplayAdvertisement():
+
+    __slots__ = ("rssi", "service_data")
+
+    def __init__(self, rssi, service_data):
+        self.rssi = rssi
+        self.service_data = service_data
+
+
+class ReplayScanner():
+    """
+        Drop-in stand-in for BleakScanner that feeds the frames of a capture file
+        to the detection callback instead of listening on a Bluetooth adapter.
+
+        'speed' is the replay rate relative to the recording (1 = real time,
+        10 = ten times faster); None replays as fast as possible. The 'finished'
+        event is set once the whole file has been replayed.
+    """
+
+    def __init__(self, detection_callback, path, speed=1.0, yield_every=256):
+
+        self.detection_callback = detection_callback
+        self.path = path
+        self.speed = speed
+        self.yield_every = yield_every
+        self.frames = 0
+        self.task = None
+        self.finished = asyncio.Event()
+
+
+    async def start(self):
+
+        self.task = asyncio.create_task(self.__replay())
+
+
+    async def stop(self):
+
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+    async def __replay(self):
+
+        try:
+            await self.__feed()
+        except (OSError, ValueError) as E:
+            log.error("ReplayScanner: cannot replay %s: %s", self.path, E)
+        finally:
+            # also on error, so that whoever waits for the replay is not left hanging
+            self.finished.set()
+
+
+    async def __feed(self):
+
+        first_ts = None
+        start = time.monotonic_ns()
+
+        for ts_ns, address, rssi, service_uuid, payload in read_capture(self.path):
+
+            if first_ts is None:
+                first_ts = ts_ns
+
+            if self.speed:
+                delay = (ts_ns - first_ts) / self.speed - (time.monotonic_ns() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay / 1e9)
+
+            self.detection_callback(ReplayDevice(address), ReplayAdvertisement(rssi, {service_uuid: payload}))
+            self.frames += 1
+
+            # as fast as possible, but let the consumers run
+            if not self.speed and self.frames % self.yield_every == 0:
+                await asyncio.sleep(0)
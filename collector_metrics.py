@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import time
+import bisect
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+# seconds; spans a sub-microsecond decode up to a slow InfluxDB write
+DEFAULT_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels):
+
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+               for value in labels.values())
+
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels.keys(), escaped)) + "}"
+
+
+def format_value(value):
+
+    if value is None:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Histogram():
+    """
+        Cumulative-bucket histogram in the Prometheus sense. observe() is a
+        bisect plus two additions, cheap enough for the per-frame hot path.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+
+    def observe(self, seconds):
+
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+
+
+    def time(self):
+        """
+            Context manager observing the duration of its block.
+        """
+
+        return HistogramTimer(self)
+
+
+    def samples(self, name):
+
+        lines = []
+        cumulative = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum {self.sum!r}")
+        lines.append(f"{name}_count {cumulative}")
+
+        return lines
+
+
+class HistogramTimer():
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+
+        self.histogram = histogram
+        self.start = None
+
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry():
+    """
+        A minimal Prometheus text exposition (format 0.0.4) registry.
+
+        Counters and gauges are read at scrape time from a function, so they can
+        point at the stats dictionaries the components keep anyway and add no
+        cost to the hot path. The function returns a number, or a list of
+        (labels dict, number) for labelled series.
+    """
+
+    def __init__(self, prefix="enviro_"):
+
+        self.prefix = prefix
+
+        # (name, help, type, function or Histogram)
+        self.metrics = []
+
+
+    def counter(self, name, help_text, fn):
+
+        self.metrics.append((f"{self.prefix}{name}", help_text, "counter", fn))
+
+
+    def gauge(self, name, help_text, fn):
+
+        self.metrics.append((f"{self.prefix}{name}", help_text, "gauge", fn))
+
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+
+        histogram = Histogram(buckets)
+        self.metrics.append((f"{self.prefix}{name}", help_text, "histogram", histogram))
+        return histogram
+
+
+    def render(self):
+
+        lines = []
+
+        for name, help_text, metric_type, source in self.metrics:
+
+            # text format 0.0.4 has no counter family name apart from its samples,
+            # so HELP/TYPE name the '_total' samples (as prometheus_client does)
+            sample_name = f"{name}_total" if metric_type == "counter" and not name.endswith("_total") else name
+
+            lines.append(f"# HELP {sample_name} {help_text}")
+            lines.append(f"# TYPE {sample_name} {metric_type}")
+
+            if metric_type == "histogram":
+                lines.extend(source.samples(name))
+                continue
+
+            try:
+                value = source()
+            except Exception as E:
+                log.warning("MetricsRegistry: cannot collect %s: %s", name, E)
+                continue
+
+            if isinstance(value, list):
+                for labels, sample in value:
+                    lines.append(f"{sample_name}{format_labels(labels)} {format_value(sample)}")
+            else:
+                lines.append(f"{sample_name} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+class LoopLagMonitor():
+    """
+        Measures event loop lag: how much later than requested a sleep() wakes up.
+        Anything blocking the loop (slow callbacks, GC pauses, CPU starvation) shows up here.
+    """
+
+    def __init__(self, histogram=None, interval=0.5):
+
+        self.histogram = histogram
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+
+    async def run(self):
+
+        while True:
+
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+
+            self.lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+
+            if self.histogram:
+                self.histogram.observe(self.lag)
+
+
+async def start_metrics_server(registry, host="0.0.0.0", port=9101):
+    """
+        Serve 'registry' on http://host:port/metrics from the running event loop.
+        Returns the aiohttp AppRunner; call its cleanup() to stop.
+    """
+
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import os
+import json
+import time
+import signal
+import asyncio
+import cProfile
+import logging
+import threading
+import functools
+import tracemalloc
+import contextvars
+from collections import deque
+
+from sensor_registry import int_to_mac
+
+log = logging.getLogger(__name__)
+
+# stage timings of the frame being processed by the current consumer task
+_current_frame = contextvars.ContextVar("current_frame", default=None)
+
+
+class Profiler():
+    """
+        Opt-in profiling of the long-running collector, toggled at runtime.
+
+        The hot path is wrapped with stage timers (detection callback, decode,
+        dedup, forward, InfluxDB write) that cost one attribute check while
+        profiling is off. toggle() (e.g., on SIGUSR1) starts a profiling session:
+        stage timers, cProfile for the event loop thread and tracemalloc. The next
+        toggle() stops it and writes to 'output_dir' (from a worker thread when
+        called inside the event loop, so the loop keeps running):
+
+            profile-<time>.prof          cProfile stats (python3 -m pstats, snakeviz, ...)
+            profile-<time>.tracemalloc   tracemalloc snapshot (tracemalloc.Snapshot.load)
+            profile-<time>.json          per-stage totals and the last 'ring_size'
+                                         per-frame stage timings (ns)
+    """
+
+    def __init__(self, output_dir="profiles", ring_size=4096, tracemalloc_frames=10):
+
+        self.output_dir = output_dir
+        self.tracemalloc_frames = tracemalloc_frames
+        self.enabled = False
+        self.started = None
+        self.profile = None
+        # tracemalloc was started by this session (and is stopped with it)
+        self.tracing = False
+        # results of the last session are still being written
+        self.dumping = False
+
+        # stage -> [calls, total ns, max ns]; stages also run on other threads (e.g., "write")
+        self.stages = {}
+        self.lock = threading.Lock()
+
+        # per-frame stage timings of the most recent frames
+        self.frames = deque(maxlen=ring_size)
+
+
+    def toggle(self):
+
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+
+    def start(self):
+
+        if self.enabled:
+            return
+
+        if self.dumping:
+            log.warning("Profiler: results of the previous session are still being written")
+            return
+
+        with self.lock:
+            self.stages = {}
+        self.frames.clear()
+        self.started = time.time()
+
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(self.tracemalloc_frames)
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.enabled = True
+
+        log.warning("Profiler: started")
+
+
+    def stop(self):
+        """
+            Stop the session and write its results. Returns the path prefix of the files written.
+            Inside a running event loop the results are written by its default executor.
+        """
+
+        if not self.enabled:
+            return None
+
+        self.enabled = False
+        self.profile.disable()
+
+        profile = self.profile
+        self.profile = None
+        summary = self.summary()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, time.strftime("profile-%Y%m%d-%H%M%S"))
+
+        self.dumping = True
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop:
+            loop.run_in_executor(None, self.__dump, profile, summary, prefix)
+            return prefix
+
+        return self.__dump(profile, summary, prefix)
+
+
+    def __dump(self, profile, summary, prefix):
+
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            if self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+
+            try:
+                profile.dump_stats(f"{prefix}.prof")
+                snapshot.dump(f"{prefix}.tracemalloc")
+                with open(f"{prefix}.json", "w") as f:
+                    json.dump(summary, f, indent=2)
+            except OSError as E:
+                log.error("Profiler: cannot write results to %s: %s", self.output_dir, E)
+                return None
+
+            for stat in snapshot.statistics("lineno")[:10]:
+                log.warning("Profiler: %s", stat)
+        finally:
+            self.dumping = False
+
+        log.warning("Profiler: stopped, results in %s.*", prefix)
+        return prefix
+
+
+    def install_signal(self, loop=None, sig=signal.SIGUSR1):
+        """
+            Toggle profiling on 'sig' (e.g., systemctl kill -s USR1 enviro-watch).
+        """
+
+        try:
+            if loop:
+                loop.add_signal_handler(sig, self.toggle)
+            else:
+                signal.signal(sig, lambda signum, frame: self.toggle())
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError) as E:
+            log.warning("Profiler: cannot install signal handler: %s", E)
+
+
+    def summary(self):
+
+        duration = time.time() - self.started if self.started else 0.0
+
+        with self.lock:
+            stages = {name: tuple(stats) for name, stats in self.stages.items()}
+
+        stages = {
+            name: {
+                "calls": calls,
+                "total_ms": round(total / 1e6, 3),
+                "mean_us": round(total / calls / 1e3, 3) if calls else None,
+                "max_us": round(max_ns / 1e3, 3)
+            }
+            for name, (calls, total, max_ns) in stages.items()
+        }
+
+        frames = [dict(frame, mac=int_to_mac(frame["mac"])) for frame in self.frames]
+
+        return {"duration_seconds": round(duration, 3), "stages": stages, "frames": frames}
+
+    #############
+
+    def stage(self, name, elapsed_ns):
+        """
+            Account 'elapsed_ns' to a stage, and to the frame of the current task (if any).
+        """
+
+        with self.lock:
+
+            stats = self.stages.get(name, None)
+            if stats is None:
+                stats = self.stages[name] = [0, 0, 0]
+
+            stats[0] += 1
+            stats[1] += elapsed_ns
+            if elapsed_ns > stats[2]:
+                stats[2] = elapsed_ns
+
+        frame = _current_frame.get()
+        if frame is not None:
+            frame[name] = frame.get(name, 0) + elapsed_ns
+
+
+    def begin_frame(self, mac_int, ts_ns):
+        """
+            Start collecting the stage timings of one frame in the current task.
+        """
+
+        frame = {"ts_ns": ts_ns, "mac": mac_int, "queue_wait": time.time_ns() - ts_ns}
+        _current_frame.set(frame)
+        return frame
+
+
+    def end_frame(self, frame):
+
+        frame["total"] = time.time_ns() - frame["ts_ns"]
+        self.frames.append(frame)
+        _current_frame.set(None)
+
+
+    def wrap(self, name, fn):
+        """
+            Time every call of 'fn' as stage 'name' while profiling is on.
+        """
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.stage(name, time.perf_counter_ns() - start)
+
+        return wrapper
+
+
+    def wrap_async(self, name, fn):
+        """
+            wrap() for coroutine functions.
+        """
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return await fn(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.stage(name, time.perf_counter_ns() - start)
+
+        return wrapper
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+# default thresholds: a reading is forwarded once a field moved at least this much
+DEFAULT_THRESHOLDS = {
+    "temperature": 0.1,    # C or F
+    "humidity": 1,         # percent
+    "battery_level": 1     # percent
+}
+
+# readings are quantized (0.1 degree, 1 mV), but their float differences are not:
+# 21.7 - 21.6 = 0.0999..., which must still count as a 0.1 step
+EPSILON = 1e-6
+
+
+class DeadbandFilter():
+    """
+        Change-only reporting: a reading is forwarded only if one of the watched
+        fields moved by at least its threshold since the last forwarded reading of
+        that sensor, or if nothing was forwarded for 'heartbeat_seconds'.
+
+        Thresholds and heartbeat can be overridden per sensor in the sensor file,
+        either as a table or as flat keys (for CSV):
+
+            deadband = { temperature = 0.2, humidity = 2 }
+            heartbeat = 900
+
+            deadband_temperature,deadband_humidity,heartbeat
+    """
+
+    def __init__(self, thresholds=None, heartbeat_seconds=10*60):
+
+        self.thresholds = dict(DEFAULT_THRESHOLDS if thresholds is None else thresholds)
+        self.heartbeat_seconds = heartbeat_seconds
+
+        # mac_raw -> (ts_ns, {field: value}) of the last forwarded reading
+        self.last_forwarded = {}
+
+        # id(sensor entry) -> (sensor entry, thresholds, heartbeat_ns)
+        self.sensor_config = {}
+
+        self.stats = {
+            "forwarded": 0,
+            "suppressed": 0,
+            "heartbeats": 0
+        }
+
+
+    def should_forward(self, reading, sensor=None):
+
+        thresholds, heartbeat_ns = self.__config(sensor)
+
+        last = self.last_forwarded.get(reading.mac_raw, None)
+
+        forward = last is None
+        if not forward:
+
+            last_ts, last_values = last
+
+            for field, threshold in thresholds.items():
+                last_value = last_values.get(field, None)
+                if last_value is None or abs(getattr(reading, field) - last_value) >= threshold - EPSILON:
+                    forward = True
+                    break
+
+            if not forward and reading.ts_ns - last_ts >= heartbeat_ns:
+                forward = True
+                self.stats["heartbeats"] += 1
+
+        if not forward:
+            self.stats["suppressed"] += 1
+            return False
+
+        self.last_forwarded[reading.mac_raw] = (reading.ts_ns, {field: getattr(reading, field) for field in thresholds})
+        self.stats["forwarded"] += 1
+        return True
+
+
+    def __config(self, sensor):
+
+        if not sensor:
+            return self.thresholds, int(self.heartbeat_seconds * 1e9)
+
+        # registry entries are replaced (not mutated) on reload, so id() is a safe cache key
+        cached = self.sensor_config.get(id(sensor), None)
+        if cached and cached[0] is sensor:
+            return cached[1], cached[2]
+
+        thresholds = dict(self.thresholds)
+        thresholds.update(sensor.get("deadband", None) or {})
+
+        for key, value in sensor.items():
+            if key.startswith("deadband_") and value not in (None, ""):
+                thresholds[key[len("deadband_"):]] = value
+
+        thresholds = {field: float(value) for field, value in thresholds.items()}
+        heartbeat_ns = int(float(sensor.get("heartbeat", None) or self.heartbeat_seconds) * 1e9)
+
+        if len(self.sensor_config) >= 10_000:
+            self.sensor_config = {}  # stale entries from earlier registry reloads
+        self.sensor_config[id(sensor)] = (sensor, thresholds, heartbeat_ns)
+        return thresholds, heartbeat_ns
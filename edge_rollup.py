@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import time
+
+ROLLUP_FIELDS = ("temperature", "humidity", "battery_level", "rssi")
+
+
+class RunningStat():
+    """
+        count/min/max/mean/last of one field, updated in O(1).
+    """
+
+    __slots__ = ("count", "min", "max", "sum", "last")
+
+    def __init__(self):
+
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.last = None
+
+
+    def update(self, value):
+
+        if self.count:
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        else:
+            self.min = self.max = value
+
+        self.count += 1
+        self.sum += value
+        self.last = value
+
+
+    def summary(self, prefix):
+
+        return {
+            f"{prefix}_min": float(self.min),
+            f"{prefix}_max": float(self.max),
+            f"{prefix}_mean": round(self.sum / self.count, 3),
+            f"{prefix}_last": float(self.last)
+        }
+
+
+class SensorWindow():
+
+    __slots__ = ("start_ns", "stats", "count")
+
+    def __init__(self, start_ns, fields):
+
+        self.start_ns = start_ns
+        self.stats = [RunningStat() for _ in fields]
+        self.count = 0
+
+
+class EdgeRollup():
+    """
+        Per-sensor tumbling windows of 'window_seconds' (aligned to the clock,
+        e.g., :00, :05, :10 for 5 minutes) over the readings of each sensor.
+
+        add() updates the sensor's window in O(1) and returns the summary of the
+        previous window once a reading falls into a new one. expire() closes the
+        windows of sensors that went silent, and flush() closes all of them
+        (on shutdown). A summary is (mac_raw, window start in ns, fields), with
+        'count' plus <field>_min/_max/_mean/_last for every rolled-up field.
+
+        A window is summarized once: a reading for a window that was already
+        emitted (or that is older than the sensor's current window) is dropped
+        and counted as late, as its summary would overwrite the emitted one.
+    """
+
+    def __init__(self, window_seconds=5*60, fields=ROLLUP_FIELDS, expire_interval=10.0):
+
+        self.window_ns = int(window_seconds * 1e9)
+        self.fields = fields
+        self.expire_interval_ns = int(expire_interval * 1e9)
+        self.next_expire_ns = 0
+
+        # mac_raw -> SensorWindow
+        self.windows = {}
+
+        # mac_raw -> start (ns) of the last window summarized
+        self.emitted = {}
+
+        self.stats = {
+            "late": 0
+        }
+
+
+    def add(self, reading):
+
+        start_ns = reading.ts_ns - reading.ts_ns % self.window_ns
+
+        summary = None
+        window = self.windows.get(reading.mac_raw, None)
+
+        if (window is not None and start_ns < window.start_ns) or start_ns <= self.emitted.get(reading.mac_raw, -1):
+            self.stats["late"] += 1
+            return None
+
+        if window is None or window.start_ns != start_ns:
+            if window is not None and window.count:
+                summary = self.__summary(reading.mac_raw, window)
+            window = self.windows[reading.mac_raw] = SensorWindow(start_ns, self.fields)
+
+        window.count += 1
+        for stat, field in zip(window.stats, self.fields):
+            stat.update(getattr(reading, field))
+
+        return summary
+
+
+    def expire(self, now_ns=None):
+        """
+            Close windows that ended before 'now_ns' (minus a grace period) and return their summaries.
+            Does nothing if called again within 'expire_interval' seconds.
+        """
+
+        if now_ns is None:
+            now_ns = time.time_ns()
+
+        if now_ns < self.next_expire_ns:
+            return []
+        self.next_expire_ns = now_ns + self.expire_interval_ns
+
+        summaries = []
+
+        # a grace period of one expire interval lets late readings still make it in
+        for mac_raw, window in list(self.windows.items()):
+            if window.start_ns + self.window_ns + self.expire_interval_ns <= now_ns:
+                summaries.append(self.__summary(mac_raw, window))
+                del self.windows[mac_raw]
+
+        return summaries
+
+
+    def flush(self):
+        """
+            Close all windows, including the ones still in progress.
+        """
+
+        summaries = [self.__summary(mac_raw, window) for mac_raw, window in self.windows.items()]
+        self.windows = {}
+        return summaries
+
+
+    def __summary(self, mac_raw, window):
+
+        self.emitted[mac_raw] = window.start_ns
+
+        fields = {"count": window.count}
+        for stat, field in zip(window.stats, self.fields):
+            fields.update(stat.summary(field))
+
+        return mac_raw, window.start_ns, fields
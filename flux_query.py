@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+from datetime import datetime, timezone
+
+
+def flux_string(value):
+
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{value}"'
+
+
+def flux_time(value):
+    """
+        A Flux time or duration literal: "-30d", "now()", a datetime, or epoch seconds.
+    """
+
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.astimezone()  # naive means local time
+        return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).isoformat().replace("+00:00", "Z")
+
+    return str(value)
+
+
+def build_query(bucket="home_sensors",
+                start="-1h",
+                stop=None,
+                measurement="ble_sensor_rollup",
+                fields=None,
+                tags=None,
+                every=None,
+                fn="mean",
+                create_empty=False,
+                pivot=False,
+                keep=None):
+    """
+        Build a Flux query over one measurement, e.g., hourly mean humidity of
+        all rooms over the last year, downsampled on the server from the 5-minute
+        rollups the collector writes by default:
+
+            build_query(start="-365d", fields=["humidity_mean"], every="1h")
+
+        Raw readings (forward_raw, or the aggregator) are in measurement="ble_sensor".
+
+        'tags' maps a tag to a value or a list of values (any of them matches).
+        'every' adds aggregateWindow() with 'fn'; 'pivot' turns the fields into
+        columns (one row per time and series); 'keep' limits the output columns.
+    """
+
+    lines = [f"from(bucket: {flux_string(bucket)})"]
+
+    time_range = f"start: {flux_time(start)}"
+    if stop is not None:
+        time_range += f", stop: {flux_time(stop)}"
+    lines.append(f"|> range({time_range})")
+
+    if measurement:
+        lines.append(f'|> filter(fn: (r) => r._measurement == {flux_string(measurement)})')
+
+    if fields:
+        if isinstance(fields, str):
+            fields = [fields]
+        predicate = " or ".join(f"r._field == {flux_string(field)}" for field in fields)
+        lines.append(f"|> filter(fn: (r) => {predicate})")
+
+    for tag, values in (tags or {}).items():
+        if isinstance(values, (str, int, float)):
+            values = [values]
+        predicate = " or ".join(f"r[{flux_string(tag)}] == {flux_string(value)}" for value in values)
+        lines.append(f"|> filter(fn: (r) => {predicate})")
+
+    if every:
+        lines.append(f"|> aggregateWindow(every: {every}, fn: {fn}, createEmpty: {'true' if create_empty else 'false'})")
+
+    if pivot:
+        lines.append('|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")')
+
+    if keep:
+        columns = ", ".join(flux_string(column) for column in keep)
+        lines.append(f"|> keep(columns: [{columns}])")
+
+    return "\n".join(lines)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+
+class FrameDedup():
+    """
+        In-process (MAC, frame counter) deduplication.
+
+        For each MAC we keep the frame counters seen in the last 'ttl_seconds'.
+        A sensor bumps its 8-bit counter about once a minute, so a counter only
+        comes back after ~4 hours, long after its entry has expired; wraparound
+        therefore needs no special casing.
+
+        If 'redis_h' is given, Redis is consulted as a second tier, but only on a
+        local miss (i.e., once per new frame rather than once per advertisement).
+        If 'snapshot_path' is given, the cache is saved there every
+        'snapshot_interval' seconds and loaded back on start-up, so dedup
+        survives restarts without Redis.
+    """
+
+    def __init__(self,
+                 ttl_seconds=2*60,
+                 redis_h=None,
+                 snapshot_path=None,
+                 snapshot_interval=60):
+
+        self.ttl_seconds = ttl_seconds
+        self.redis_h = redis_h
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.next_snapshot = time.monotonic() + snapshot_interval
+
+        # mac -> {frame_counter: last seen (epoch seconds)}
+        self.seen = {}
+
+        self.stats = {
+            "local_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "redis_errors": 0
+        }
+
+        if snapshot_path:
+            self.load()
+
+
+    def is_duplicate(self, mac_address, frame_counter):
+
+        now = time.time()
+
+        counters = self.seen.get(mac_address, None)
+        if counters is None:
+            counters = self.seen[mac_address] = {}
+
+        last_seen = counters.get(frame_counter, None)
+        if last_seen is not None and now - last_seen < self.ttl_seconds:
+            self.stats["local_hits"] += 1
+            return True
+
+        # drop expired counters of this sensor (a handful at most)
+        for counter in [c for c, ts in counters.items() if now - ts >= self.ttl_seconds]:
+            del counters[counter]
+
+        counters[frame_counter] = now
+
+        duplicate = self.__check_redis(mac_address, frame_counter)
+        if duplicate:
+            self.stats["redis_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+
+        if self.snapshot_path and time.monotonic() >= self.next_snapshot:
+            self.save()
+
+        return duplicate
+
+
+    def __check_redis(self, mac_address, frame_counter):
+
+        if not self.redis_h:
+            return False
+
+        key = f"dedup:{mac_address.upper()}:{frame_counter}"
+
+        try:
+            # NX = Only set the key if it does not already exist
+            result = self.redis_h.set(key, 1, nx=True, ex=self.ttl_seconds)
+        except Exception as E:
+            self.stats["redis_errors"] += 1
+            log.warning("FrameDedup: redis check failed: %s", E)
+            return False  # still proceed
+
+        return not result
+
+    #############
+
+    def load(self):
+
+        try:
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as E:
+            log.warning("FrameDedup: cannot load snapshot %s: %s", self.snapshot_path, E)
+            return
+
+        now = time.time()
+
+        for mac_address, counters in snapshot.items():
+            counters = {int(c): ts for c, ts in counters.items() if now - ts < self.ttl_seconds}
+            if counters:
+                self.seen[mac_address] = counters
+
+
+    def save(self):
+
+        self.next_snapshot = time.monotonic() + self.snapshot_interval
+
+        now = time.time()
+        snapshot = {}
+
+        for mac_address, counters in self.seen.items():
+            counters = {c: ts for c, ts in counters.items() if now - ts < self.ttl_seconds}
+            if counters:
+                snapshot[mac_address] = counters
+
+        # write to a temp file first so a crash never leaves a truncated snapshot
+        tmp_path = f"{self.snapshot_path}.tmp"
+
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as E:
+            log.warning("FrameDedup: cannot save snapshot %s: %s", self.snapshot_path, E)
+
+
+class AsyncRedisDedup():
+    """
+        Redis dedup shared by several collectors, built on redis.asyncio.
+
+        Instead of one round-trip per frame, check() calls are collected for up to
+        'flush_interval' seconds (or 'max_batch' keys) and resolved together with a
+        single Lua script call. Each key is claimed with SET NX EX and the value is
+        the id of the collector that claimed it first, so the result also tells
+        which collector "won" the frame. Redis load and latency therefore scale
+        with the number of batches, not with the number of advertisements.
+    """
+
+    # returns {claimed (1/0), winner} for every key
+    CLAIM_SCRIPT = """
+        local result = {}
+        for i, key in ipairs(KEYS) do
+            if redis.call('SET', key, ARGV[1], 'NX', 'EX', ARGV[2]) then
+                result[i] = {1, ARGV[1]}
+            else
+                result[i] = {0, redis.call('GET', key) or ''}
+            end
+        end
+        return result
+    """
+
+    def __init__(self,
+                 redis_h,
+                 collector_id,
+                 ttl_seconds=2*60,
+                 flush_interval=0.005,
+                 max_batch=256):
+
+        self.redis_h = redis_h
+        self.collector_id = collector_id
+        self.ttl_seconds = ttl_seconds
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        self.claim_script = redis_h.register_script(self.CLAIM_SCRIPT)
+        self.pending = {}
+        self.flush_task = None
+
+        # optional histogram (anything with observe(seconds)) for the duration of each Redis call
+        self.latency = None
+
+        self.stats = {
+            "checks": 0,
+            "batches": 0,
+            "duplicates": 0,
+            "errors": 0
+        }
+
+        # collector id -> frames it claimed first, among the frames this collector checked
+        self.winners = Counter()
+
+
+    async def check(self, mac_address, frame_counter):
+        """
+            Returns (is_duplicate, winner) where winner is the id of the collector
+            that claimed this frame first (None if Redis could not be reached).
+        """
+
+        self.stats["checks"] += 1
+
+        key = f"dedup:{mac_address.upper()}:{frame_counter}"
+
+        future = self.pending.get(key, None)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+        else:
+            # asked twice within one batch: the second one is a duplicate for sure
+            self.stats["duplicates"] += 1
+            duplicate, winner = await asyncio.shield(future)
+            return True, winner
+
+        if len(self.pending) >= self.max_batch:
+            await self.flush()
+        elif not self.flush_task:
+            self.flush_task = asyncio.create_task(self.__flush_later())
+
+        return await asyncio.shield(future)
+
+
+    async def flush(self):
+
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = {}
+        keys = list(batch.keys())
+
+        self.stats["batches"] += 1
+        start = time.perf_counter()
+
+        try:
+            results = await self.claim_script(keys=keys, args=[self.collector_id, self.ttl_seconds])
+            if self.latency:
+                self.latency.observe(time.perf_counter() - start)
+        except Exception as E:
+            self.stats["errors"] += 1
+            log.warning("AsyncRedisDedup: redis check failed: %s", E)
+            results = [(1, None)] * len(keys)  # still proceed
+
+        for key, (claimed, winner) in zip(keys, results):
+
+            if isinstance(winner, bytes):
+                winner = winner.decode()
+
+            duplicate = not claimed
+            if duplicate:
+                self.stats["duplicates"] += 1
+            if winner:
+                self.winners[winner] += 1
+
+            future = batch[key]
+            if not future.done():
+                future.set_result((duplicate, winner or None))
+
+
+    async def __flush_later(self):
+
+        try:
+            await asyncio.sleep(self.flush_interval)
+        finally:
+            # cleared before the Redis call, so checks arriving while
+            # this batch is in flight schedule the next flush
+            self.flush_task = None
+
+        await self.flush()
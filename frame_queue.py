@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import asyncio
+from collections import deque, Counter
+
+DROP_OLDEST = "drop-oldest"
+DROP_DUPLICATES_FIRST = "drop-duplicates-first"
+BLOCK = "block"
+
+POLICIES = (DROP_OLDEST, DROP_DUPLICATES_FIRST, BLOCK)
+
+
+class FrameQueue():
+    """
+        Bounded asyncio queue of raw advertisement frames sitting between the
+        BLE detection callback (producer) and the decode/forward tasks (consumers).
+
+        A frame is a tuple whose first two items are (address, payload); these
+        form the duplicate key. When the queue is full, 'policy' decides what happens:
+
+            drop-oldest            : evict the oldest queued frame
+            drop-duplicates-first  : drop a frame that repeats one already queued
+                                     (the incoming one, or else the oldest repeat),
+                                     falling back to drop-oldest
+            block                  : put() waits for room, and put_nowait() parks
+                                     the frame until room frees up; at most 'maxsize'
+                                     frames are parked, beyond that the oldest parked
+                                     frame is dropped
+
+        The detection callback is synchronous, so it must use put_nowait().
+        'on_drop' (optional) is called with every queued frame that is evicted
+        while no other copy of it remains queued.
+
+        Like asyncio.Queue, consumers call task_done() for every frame they got
+        and join() waits until every queued frame has been processed or dropped.
+    """
+
+    def __init__(self, maxsize=1024, policy=DROP_OLDEST, on_drop=None):
+
+        if policy not in POLICIES:
+            raise ValueError(f"FrameQueue: unknown policy '{policy}', expected one of {POLICIES}")
+
+        if maxsize <= 0:
+            raise ValueError("FrameQueue: maxsize must be positive")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+
+        self.frames = deque()
+        self.parked = deque()
+        self.keys = Counter()
+        self.repeats = 0
+        self.getters = deque()
+        self.putters = deque()
+        self.joiners = deque()
+        # queued frames not yet marked done by task_done()
+        self.unfinished = 0
+
+        self.stats = {
+            "enqueued": 0,
+            "dequeued": 0,
+            "dropped_oldest": 0,
+            "dropped_duplicate": 0,
+            "dropped_parked": 0,
+            "blocked": 0,
+            "max_depth": 0
+        }
+
+
+    def depth(self):
+
+        return len(self.frames) + len(self.parked)
+
+
+    def full(self):
+
+        return len(self.frames) >= self.maxsize
+
+
+    def put_nowait(self, frame):
+        """
+            Enqueue a frame without waiting. Returns False if the frame itself was dropped.
+        """
+
+        if self.full():
+
+            if self.policy == BLOCK:
+                if len(self.parked) >= self.maxsize:
+                    dropped = self.parked.popleft()
+                    self.stats["dropped_parked"] += 1
+                    if self.on_drop and dropped[:2] not in self.keys:
+                        self.on_drop(dropped)
+                self.parked.append(frame)
+                self.stats["blocked"] += 1
+                self.__update_depth()
+                return True
+
+            if self.policy == DROP_DUPLICATES_FIRST:
+                if self.keys[frame[:2]]:
+                    self.stats["dropped_duplicate"] += 1
+                    return False
+                if self.repeats and self.__drop_repeat():
+                    self.stats["dropped_duplicate"] += 1
+                    return self.__append(frame)
+
+            self.__evict(self.frames.popleft())
+            self.stats["dropped_oldest"] += 1
+
+        return self.__append(frame)
+
+
+    async def put(self, frame):
+        """
+            Enqueue a frame; under the 'block' policy wait until there is room.
+        """
+
+        while self.policy == BLOCK and (self.full() or self.parked):
+            putter = asyncio.get_running_loop().create_future()
+            self.putters.append(putter)
+            try:
+                await putter
+            except asyncio.CancelledError:
+                putter.cancel()
+                raise
+
+        return self.put_nowait(frame)
+
+
+    async def get(self):
+
+        while not self.frames:
+            getter = asyncio.get_running_loop().create_future()
+            self.getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                getter.cancel()
+                raise
+
+        frame = self.frames.popleft()
+        self.__remove(frame)
+        self.stats["dequeued"] += 1
+
+        # room was freed: admit a parked frame or wake a waiting producer
+        if self.parked:
+            self.__append(self.parked.popleft())
+        else:
+            self.__wakeup(self.putters)
+
+        return frame
+
+
+    def task_done(self):
+        """
+            Mark a frame returned by get() as processed.
+        """
+
+        if self.unfinished <= 0:
+            raise ValueError("FrameQueue: task_done() called too many times")
+
+        self.__finish()
+
+
+    async def join(self):
+        """
+            Wait until every queued frame has been processed or dropped.
+        """
+
+        while self.unfinished:
+            joiner = asyncio.get_running_loop().create_future()
+            self.joiners.append(joiner)
+            try:
+                await joiner
+            except asyncio.CancelledError:
+                joiner.cancel()
+                raise
+
+    #############
+
+    def __append(self, frame):
+
+        key = frame[:2]
+        if self.keys[key]:
+            self.repeats += 1
+        self.keys[key] += 1
+
+        self.frames.append(frame)
+        self.unfinished += 1
+        self.stats["enqueued"] += 1
+        self.__update_depth()
+        self.__wakeup(self.getters)
+        return True
+
+
+    def __remove(self, frame):
+
+        key = frame[:2]
+        self.keys[key] -= 1
+        if self.keys[key]:
+            self.repeats -= 1
+        else:
+            del self.keys[key]
+
+
+    def __finish(self):
+
+        self.unfinished -= 1
+        if not self.unfinished:
+            while self.joiners:
+                self.__wakeup(self.joiners)
+
+
+    def __evict(self, frame):
+
+        self.__remove(frame)
+        self.__finish()
+        if self.on_drop and frame[:2] not in self.keys:
+            self.on_drop(frame)
+
+
+    def __drop_repeat(self):
+
+        for frame in self.frames:
+            if self.keys[frame[:2]] > 1:
+                self.frames.remove(frame)
+                self.__evict(frame)
+                return True
+
+        return False
+
+
+    def __update_depth(self):
+
+        depth = self.depth()
+        if depth > self.stats["max_depth"]:
+            self.stats["max_depth"] = depth
+
+
+    @staticmethod
+    def __wakeup(waiters):
+
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
@@ -5,8 +5,11 @@
 
 import os
 import sys
+import time
 import textwrap
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tabulate import tabulate
 from dotenv import load_dotenv
 
@@ -15,6 +18,9 @@ from influxdb_client import BucketRetentionRules
 from influxdb_client.client.write_api import SYNCHRONOUS
 
 import utility
+from query_cache import QueryCache
+from flux_query import flux_string
+from influxdb_schema import InfluxDB_Schema
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -23,28 +29,66 @@ load_dotenv()
 
 class InfluxDB_Access():
 
+    # process-wide instances shared by write_points() and read_points()
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    # results of read_points(), invalidated by the writes of this process (None to disable)
+    query_cache = QueryCache()
+
+    # columns the query engine adds to every record
+    BOILERPLATE_COLS = frozenset([
+        'result',
+        'table',
+        '_start',
+        '_stop',
+        '_measurement'
+    ])
+
     def __init__(self,
                  timeout=10_000,
                  url=None,
-                 org=None):
+                 org=None,
+                 connection_pool_maxsize=None):
 
         self.client = None
+        self.write_api = None
+        # buckets known to exist, re-checked only after a write error
+        self.verified_buckets = set()
+        # bucket names -> (monotonic time, InfluxDB_Schema), see get_schema()
+        self.schema_cache = {}
         self.log_influx_db_dir = os.getcwd()
         self.legacy = False
-        self.boilerplate_cols = [
-            'result',
-            'table',
-            '_start',
-            '_stop',
-            '_measurement'
-        ]
+        self.boilerplate_cols = self.BOILERPLATE_COLS
 
         token = os.getenv('INFLUXDB_TOKEN', None)
         if not token:
             log.error("InfluxDB_Access: cannot read 'INFLUXDB_TOKEN' env variable")
             sys.exit(2)
 
-        self.client = InfluxDBClient_url(url=url, token=token, org=org, timeout=timeout)
+        kwargs = {}
+        if connection_pool_maxsize:
+            kwargs["connection_pool_maxsize"] = connection_pool_maxsize
+
+        self.client = InfluxDBClient_url(url=url, token=token, org=org, timeout=timeout, **kwargs)
+
+
+    @classmethod
+    def get_shared(cls, url=None, org=None, timeout=10_000):
+        """
+            Return a long-lived instance for (url, org, timeout), creating it on first use.
+            The underlying client keeps its HTTP connections open between calls.
+        """
+
+        key = (url, org, timeout)
+
+        with cls._shared_lock:
+            influx_obj = cls._shared.get(key, None)
+            if not influx_obj:
+                influx_obj = cls(url=url, org=org, timeout=timeout, connection_pool_maxsize=4)
+                cls._shared[key] = influx_obj
+
+        return influx_obj
 
 
     def get_database_names(self, skip_internal=True):
@@ -70,86 +114,117 @@ class InfluxDB_Access():
     #############
 
     def dump_tables(self, database=None):
+        """
+            Log the measurements, tag keys and field keys of 'database' (all buckets
+            if None) and return them as an InfluxDB_Schema.
+        """
 
-        if not database:
-            status, output = self.get_database_names()
-            if not status:
-                log.error(output)
-                sys.exit(2)
-            database_list = output
-        else:
-            database_list = [database]
+        status, output = self.get_schema(database)
+        if not status:
+            log.error(output)
+            sys.exit(2)
 
-        for database_name in database_list:
-            self.__dump_tables(database_name)
+        schema = output
 
+        for bucket_name in schema.bucket_names():
 
-    def __dump_tables(self, bucket_name):
+            log.info("\nBucket: %s\n", bucket_name)
 
-        query_api = self.client.query_api()
+            headers = ['Measurement', 'Tag Keys', 'Field Keys']
+            log.info(tabulate(schema.rows(bucket_name), headers=headers, tablefmt="grid"))
 
-        try:
+        return schema
 
-            # https://docs.influxdata.com/influxdb/v2.7/query-data/flux/explore-schema/#list-measurements
-            query = f"""
-                import "influxdata/influxdb/schema"
-                schema.measurements(bucket: "{bucket_name}")
-            """
 
-            tables = query_api.query(query=query)
+    def get_schema(self, database=None, max_age=5*60):
+        """
+            Discover the schema of 'database' (all buckets if None) as an InfluxDB_Schema.
 
-        except Exception as E:
-            return False, str(E)
+            One query lists the measurements of all buckets; then one query per
+            bucket fetches the tag and field keys of all its measurements, with the
+            buckets queried concurrently. The result is cached for 'max_age' seconds.
+        """
 
-        measurements = []
-        for table in tables:
-            for record in table.records:
-                measurements.append(record.row[2])
+        if database:
+            bucket_names = [database]
+        else:
+            status, output = self.get_database_names()
+            if not status:
+                return False, output
+            bucket_names = output
 
-        rows = []
+        cache_key = tuple(bucket_names)
+        cached = self.schema_cache.get(cache_key, None)
+        if cached and time.monotonic() - cached[0] < max_age:
+            return True, cached[1]
 
-        for measurement in sorted(measurements):
+        if not bucket_names:
+            return True, InfluxDB_Schema({})
 
-            # https://docs.influxdata.com/influxdb/v2.7/query-data/flux/explore-schema/#list-tag-keys-in-a-measurement
-            query = f"""
-                import "influxdata/influxdb/schema"
+        query_api = self.client.query_api()
 
-                schema.measurementTagKeys(
-                  bucket: "{bucket_name}",
-                  measurement: "{measurement}"
-                )
-            """
+        # https://docs.influxdata.com/influxdb/v2.7/query-data/flux/explore-schema/#list-measurements
+        query = ['import "influxdata/influxdb/schema"']
+        for i, bucket_name in enumerate(bucket_names):
+            query.append(f'schema.measurements(bucket: {flux_string(bucket_name)}) |> yield(name: "m{i}")')
 
-            tables = query_api.query(query=query)
+        try:
+            tables = query_api.query("\n".join(query))
+        except Exception as E:
+            return False, f"cannot list measurements: {E}"
 
-            tags = []
-            for table in tables:
-                for record in table.records:
-                    tags.append(record.row[2])
+        measurements = {bucket_name: [] for bucket_name in bucket_names}
+        for table in tables:
+            for record in table.records:
+                measurements[bucket_names[int(record.values["result"][1:])]].append(record.get_value())
 
-            # https://docs.influxdata.com/influxdb/v2.7/query-data/flux/explore-schema/#list-fields-in-a-measurement
-            query = f"""
-                import "influxdata/influxdb/schema"
+        with ThreadPoolExecutor(max_workers=min(8, len(bucket_names))) as pool:
+            results = list(pool.map(lambda bucket_name: self.__measurement_keys(query_api, bucket_name, measurements[bucket_name]),
+                                    bucket_names))
 
-                schema.measurementFieldKeys(
-                  bucket: "{bucket_name}",
-                  measurement: "{measurement}"
-                )
-            """
+        buckets = {}
+        for bucket_name, (status, output) in zip(bucket_names, results):
+            if not status:
+                return False, output
+            buckets[bucket_name] = output
 
-            tables = query_api.query(query=query)
+        schema = InfluxDB_Schema(buckets)
+        self.schema_cache[cache_key] = (time.monotonic(), schema)
+        return True, schema
 
-            fields = []
-            for table in tables:
-                for record in table.records:
-                    fields.append(record.row[2])
 
-            rows.append([measurement, ', '.join(tags), ', '.join(fields)])
+    @staticmethod
+    def __measurement_keys(query_api, bucket_name, measurements):
+        """
+            Tag and field keys of all measurements of a bucket in one combined query.
+        """
+
+        measurements = sorted(set(measurements))
+        if not measurements:
+            return True, {}
+
+        # https://docs.influxdata.com/influxdb/v2.7/query-data/flux/explore-schema/#list-tag-keys-in-a-measurement
+        # https://docs.influxdata.com/influxdb/v2.7/query-data/flux/explore-schema/#list-fields-in-a-measurement
+        query = ['import "influxdata/influxdb/schema"']
+        for i, measurement in enumerate(measurements):
+            args = f"bucket: {flux_string(bucket_name)}, measurement: {flux_string(measurement)}"
+            query.append(f'schema.measurementTagKeys({args}) |> yield(name: "t{i}")')
+            query.append(f'schema.measurementFieldKeys({args}) |> yield(name: "f{i}")')
 
-        log.info("\nBucket: %s\n", bucket_name)
+        try:
+            tables = query_api.query("\n".join(query))
+        except Exception as E:
+            return False, f"cannot list tag/field keys of bucket {bucket_name}: {E}"
 
-        headers = ['Measurement', 'Tag Keys', 'Field Keys']
-        log.info(tabulate(rows, headers=headers, tablefmt="grid"))
+        keys = {measurement: {"tags": [], "fields": []} for measurement in measurements}
+
+        for table in tables:
+            for record in table.records:
+                result = record.values["result"]
+                kind = "tags" if result[0] == "t" else "fields"
+                keys[measurements[int(result[1:])]][kind].append(record.get_value())
+
+        return True, keys
 
     #############
 
@@ -158,6 +233,21 @@ class InfluxDB_Access():
         if not data_list:
             return False, "write_data: data_list is empty"
 
+        data_list = self.prepare_data(data_list)
+
+        if not data_list:
+            log.warning("write_data: data to write is empty")
+            return True, None
+
+        return self.__write_data(data_list, database_name)
+
+
+    @staticmethod
+    def prepare_data(data_list):
+        """
+            Drop the malformed points of 'data_list' (in place, if it is a list) and return it as a list.
+        """
+
         if not isinstance(data_list, list):
             data_list = [data_list]
 
@@ -174,6 +264,10 @@ class InfluxDB_Access():
 
         for data in data_list[:]:
 
+            # line protocol strings are passed through as they are
+            if isinstance(data, str):
+                continue
+
             # if measurement exists, but has empty value
             measurement = data.get("measurement", None)
             if measurement is None or not measurement:
@@ -196,26 +290,44 @@ class InfluxDB_Access():
                 log.warning("write_data: no 'fields' is present in data")
                 continue
 
-        if not data_list:
-            log.warning("write_data: data to write is empty")
-            return True, None
-
-        return self.__write_data(data_list, database_name)
+        return data_list
 
 
     def __write_data(self, data_list, bucket_name):
 
-        status, output = self.get_database_names()
+        status, output = self.__ensure_bucket(bucket_name)
         if not status:
             return False, output
 
-        database_list = output
+        # the write API waits for the server to confirm that the data was written successfully before
+        # returning control back to the caller. This means that the write operation is synchronous
+        # i.e., the write API is blocked until the write operation is completed.
 
         try:
-            # Create a new bucket (if not exists)
-            if bucket_name not in database_list:
+            if not self.write_api:
+                self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+            self.write_api.write(bucket=bucket_name, record=data_list)
+        except Exception as E:
+            # the bucket might have been deleted behind our back
+            self.verified_buckets.discard(bucket_name)
+            return False, f"cannot write to bucket {bucket_name}: {E}"
+
+        if self.query_cache:
+            self.query_cache.invalidate_points(data_list, bucket_name)
+
+        return True, None
 
-                buckets_api = self.client.buckets_api()
+
+    def __ensure_bucket(self, bucket_name):
+
+        if bucket_name in self.verified_buckets:
+            return True, None
+
+        try:
+            buckets_api = self.client.buckets_api()
+
+            # Create a new bucket (if not exists)
+            if not buckets_api.find_bucket_by_name(bucket_name):
 
                 months = 1
                 days = months * 30
@@ -231,25 +343,26 @@ class InfluxDB_Access():
         except Exception as E:
             return False, f"cannot create bucket {bucket_name}: {E}"
 
-        # the write API waits for the server to confirm that the data was written successfully before
-        # returning control back to the caller. This means that the write operation is synchronous
-        # i.e., the write API is blocked until the write operation is completed.
-
-        try:
-            write_api = self.client.write_api(write_options=SYNCHRONOUS)
-            write_api.write(bucket=bucket_name, record=data_list)
-        except Exception as E:
-            return False, f"cannot write to bucket {bucket_name}: {E}"
-
+        self.verified_buckets.add(bucket_name)
         return True, None
 
     #############
 
-    def read_data(self, query, omit_boilerplate_col=True):
+    def read_data(self, query, omit_boilerplate_col=True, columnar=None):
+        """
+            Run a query. By default, returns {table: {record: entry}}. With 'columnar'
+            set to "numpy" (or "arrow"), returns one NumPy array (or a pyarrow.Table
+            column) per column over all tables instead, with times as int64 ns since
+            the epoch. Where a column is missing from a table, numbers are NaN and
+            strings are None.
+        """
 
         query = textwrap.dedent(query)
         query = query.strip()
 
+        if columnar:
+            return self.__read_columns(query, omit_boilerplate_col, columnar)
+
         return self.__read_data(query, omit_boilerplate_col)
 
 
@@ -257,32 +370,219 @@ class InfluxDB_Access():
 
         try:
             query_api = self.client.query_api()
-            tables = query_api.query(query)
+            records = query_api.query_stream(query)
         except Exception as E:
             return False, f"query failed: {E}"
 
-        data_dict = {}
+        skip_cols = self.boilerplate_cols if omit_boilerplate_col else frozenset()
 
-        # going over each table
-        for table_num, table in enumerate(tables):
+        data_dict = {}
 
-            # going over records in each table
-            for record_num, record in enumerate(table.records):
+        # (result, table) -> running table number, as every yield() numbers its tables from 0
+        table_nums = {}
 
-                entry = {}
+        # table number -> records seen so far in that table
+        record_nums = {}
 
-                for key, val in record.values.items():
+        try:
+            # records are parsed one by one as they arrive, the raw tables are never held in memory
+            for record in records:
 
-                    if omit_boilerplate_col and key in self.boilerplate_cols:
-                        continue
+                table_key = (record.values.get("result", None), record.values.get("table", record.table))
+                table_num = table_nums.get(table_key, None)
+                if table_num is None:
+                    table_num = table_nums[table_key] = len(table_nums)
+                record_num = record_nums.get(table_num, 0)
+                record_nums[table_num] = record_num + 1
 
-                    entry[key] = val
+                entry = {key: val for key, val in record.values.items() if key not in skip_cols}
 
                 if entry:
                     utility.add_key(data_dict, [table_num, record_num], entry)
+        except Exception as E:
+            return False, f"query failed: {E}"
 
         return True, data_dict
 
+
+    def __read_columns(self, query, omit_boilerplate_col, columnar):
+
+        if columnar not in ("numpy", "arrow"):
+            return False, f"unknown columnar mode '{columnar}' (numpy or arrow)"
+
+        try:
+            query_api = self.client.query_api()
+            rows = query_api.query_csv(query)
+        except Exception as E:
+            return False, f"query failed: {E}"
+
+        skip_cols = self.boilerplate_cols if omit_boilerplate_col else frozenset()
+
+        # column -> raw CSV values, column -> Flux data type
+        values = {}
+        datatypes = {}
+
+        count = 0
+        datatype_row = None
+        header = None
+        selected = []
+        missing = []
+
+        try:
+            # annotated CSV: a blank line, annotations and a header row start every table
+            for row in rows:
+
+                if not row:
+                    header = None
+                    continue
+
+                if row[0] == "#datatype":
+                    datatype_row = row
+                    header = None
+                    continue
+
+                if row[0].startswith("#"):
+                    continue
+
+                if header is None:
+
+                    header = row
+                    if header[1:3] == ["error", "reference"]:
+                        error = next(rows, ["", "unknown error"])
+                        return False, f"query failed: {error[1]}"
+
+                    selected = []
+                    for i, name in enumerate(header):
+                        if i == 0 or name in skip_cols:
+                            continue
+                        datatype = datatype_row[i] if datatype_row else "string"
+                        if name not in values:
+                            values[name] = [""] * count
+                            datatypes[name] = datatype
+                        else:
+                            # e.g., _value is long for humidity but double for temperature
+                            datatypes[name] = self.__merge_datatypes(datatypes[name], datatype)
+                        selected.append((i, values[name]))
+
+                    names = set(header)
+                    missing = [column for name, column in values.items() if name not in names]
+                    continue
+
+                for i, column in selected:
+                    column.append(row[i])
+                for column in missing:
+                    column.append("")
+                count += 1
+
+        except Exception as E:
+            return False, f"query failed: {E}"
+
+        import numpy as np  # only needed for columnar results
+
+        try:
+            columns = {name: self.__to_array(np, column, datatypes[name]) for name, column in values.items()}
+        except Exception as E:
+            return False, f"query failed: {E}"
+
+        if columnar == "arrow":
+            import pyarrow as pa  # optional, only needed for Arrow results
+            return True, pa.table(columns)
+
+        return True, columns
+
+
+    @staticmethod
+    def __merge_datatypes(current, datatype):
+        """
+            Data type of a column whose tables disagree: numbers widen to double, anything else is kept as strings.
+        """
+
+        if current == datatype:
+            return current
+
+        if current.startswith("dateTime") and datatype.startswith("dateTime"):
+            return current
+
+        numbers = ("double", "long", "unsignedLong")
+        if current in numbers and datatype in numbers:
+            return "double"
+
+        return "string"
+
+
+    @staticmethod
+    def __to_array(np, column, datatype):
+
+        if datatype.startswith("dateTime"):
+            # InfluxDB returns RFC3339 in UTC ('Z'); empty values become NaT
+            times = np.array([value[:-1] if value.endswith("Z") else value for value in column], dtype="datetime64[ns]")
+            return times.astype(np.int64)
+
+        if datatype == "boolean":
+            return np.array(column) == "true"
+
+        if datatype in ("double", "long", "unsignedLong"):
+
+            array = np.array(column)
+            empty = array == ""
+
+            if datatype == "double" or empty.any():
+                return np.where(empty, "nan", array).astype(np.float64)
+
+            return array.astype(np.int64 if datatype == "long" else np.uint64)
+
+        return np.array([value if value != "" else None for value in column], dtype=object)
+
+
+    def stream_data(self, query, omit_boilerplate_col=True, chunk_size=None):
+        """
+            Run a query and return (status, generator). The generator yields flat
+            records (dicts) as they arrive from the server, or lists of up to
+            'chunk_size' records, so memory use stays the same however large the
+            result is. Errors after the query was accepted are raised by the generator.
+        """
+
+        query = textwrap.dedent(query)
+        query = query.strip()
+
+        try:
+            query_api = self.client.query_api()
+            records = query_api.query_stream(query)
+        except Exception as E:
+            return False, f"query failed: {E}"
+
+        skip_cols = self.boilerplate_cols if omit_boilerplate_col else frozenset()
+        records = self.__flat_records(records, skip_cols)
+
+        if chunk_size:
+            records = self.__chunks(records, chunk_size)
+
+        return True, records
+
+
+    @staticmethod
+    def __flat_records(records, skip_cols):
+
+        for record in records:
+            entry = {key: val for key, val in record.values.items() if key not in skip_cols}
+            if entry:
+                yield entry
+
+
+    @staticmethod
+    def __chunks(records, chunk_size):
+
+        chunk = []
+
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
     #############
 
     def remove_measurement(self, measurement_name):
@@ -315,19 +615,50 @@ class InfluxDB_Access():
         url_port = f"{url}:{port}"
 
         try:
-            influx_obj = InfluxDB_Access(url=url_port, org="home", timeout=timeout)
+            influx_obj = InfluxDB_Access.get_shared(url=url_port, org="home", timeout=timeout)
             return influx_obj.write_data(data_list, database_name)
         except (Exception, SystemExit) as E:
             return False, f"write_points failed: {E}"
 
 
     @staticmethod
-    def read_points(query, url="http://zeus.home", port=8086, timeout=None):
+    def read_points(query, url="http://zeus.home", port=8086, timeout=None, columnar=None, use_cache=True):
+        """
+            Results are cached (see query_cache.QueryCache) and shared between
+            callers, so treat them as read-only.
+        """
 
         url_port = f"{url}:{port}"
 
+        cache = InfluxDB_Access.query_cache if use_cache else None
+        if cache:
+            key = cache.key(query, url_port, columnar)
+            result = cache.get(key)
+            if result is not None:
+                return True, result
+
         try:
-            influx_obj = InfluxDB_Access(url=url_port, org="home", timeout=timeout)
-            return influx_obj.read_data(query)
+            influx_obj = InfluxDB_Access.get_shared(url=url_port, org="home", timeout=timeout)
+            status, output = influx_obj.read_data(query, columnar=columnar)
         except (Exception, SystemExit) as E:
             return False, f"read_points failed: {E}"
+
+        if status and cache:
+            cache.put(key, output)
+
+        return status, output
+
+
+    @staticmethod
+    def stream_points(query, url="http://zeus.home", port=8086, timeout=None, chunk_size=None):
+        """
+            Streaming counterpart of read_points(), see stream_data().
+        """
+
+        url_port = f"{url}:{port}"
+
+        try:
+            influx_obj = InfluxDB_Access.get_shared(url=url_port, org="home", timeout=timeout)
+            return influx_obj.stream_data(query, chunk_size=chunk_size)
+        except (Exception, SystemExit) as E:
+            return False, f"stream_points failed: {E}"
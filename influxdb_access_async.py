@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import os
+import sys
+import asyncio
+import textwrap
+import logging
+from dotenv import load_dotenv
+
+from influxdb_client import BucketRetentionRules, PostBucketRequest
+from influxdb_client.service.buckets_service import BucketsService
+from influxdb_client.service.organizations_service import OrganizationsService
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+import utility
+from influxdb_access import InfluxDB_Access
+
+log = logging.getLogger(__name__)
+
+load_dotenv()
+
+class InfluxDB_AccessAsync():
+    """
+        asyncio counterpart of InfluxDB_Access: writes, streaming reads and bucket
+        management that never block the event loop (e.g., the one running the BLE
+        scanner), so many queries and writes can be in flight without threads.
+
+        All calls of an instance share one aiohttp session, opened by open() (or
+        'async with') inside the running loop and released by close():
+
+            async with InfluxDB_AccessAsync(url="http://zeus.home:8086", org="home") as influx:
+                status, output = await influx.write_data(points, "home_sensors")
+                status, records = await influx.stream_data(query, chunk_size=1000)
+                async for chunk in records:
+                    ...
+
+        Writes invalidate InfluxDB_Access.query_cache, like the synchronous ones.
+    """
+
+    # process-wide instances shared by write_points() and read_points(), per event loop
+    _shared = {}
+
+    def __init__(self,
+                 timeout=10_000,
+                 url=None,
+                 org=None,
+                 connection_pool_maxsize=None):
+
+        self.client = None
+        self.write_api = None
+        self.query_api = None
+        self.buckets_service = None
+        self.org_id = None
+        # buckets known to exist, re-checked only after a write error
+        self.verified_buckets = set()
+        self.boilerplate_cols = InfluxDB_Access.BOILERPLATE_COLS
+
+        self.url = url
+        self.org = org
+        self.timeout = timeout
+        self.connection_pool_maxsize = connection_pool_maxsize
+
+        self.token = os.getenv('INFLUXDB_TOKEN', None)
+        if not self.token:
+            log.error("InfluxDB_AccessAsync: cannot read 'INFLUXDB_TOKEN' env variable")
+            sys.exit(2)
+
+
+    async def open(self):
+        """
+            Create the client and its aiohttp session; must run inside the event loop that uses it.
+        """
+
+        if self.client:
+            return
+
+        kwargs = {}
+        if self.connection_pool_maxsize:
+            kwargs["connection_pool_maxsize"] = self.connection_pool_maxsize
+
+        self.client = InfluxDBClientAsync(url=self.url, token=self.token, org=self.org, timeout=self.timeout, **kwargs)
+        self.write_api = self.client.write_api()
+        self.query_api = self.client.query_api()
+        self.buckets_service = BucketsService(self.client.api_client)
+
+
+    async def close(self):
+
+        if not self.client:
+            return
+
+        client = self.client
+        self.client = self.write_api = self.query_api = self.buckets_service = None
+        await client.close()
+
+
+    async def __aenter__(self):
+
+        await self.open()
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+
+        await self.close()
+        return False
+
+
+    @classmethod
+    async def get_shared(cls, url=None, org=None, timeout=10_000):
+        """
+            Return a long-lived, open instance for (url, org, timeout) in the running
+            event loop, creating it on first use. See close_shared().
+        """
+
+        key = (asyncio.get_running_loop(), url, org, timeout)
+
+        influx_obj = cls._shared.get(key, None)
+        if not influx_obj:
+            influx_obj = cls(url=url, org=org, timeout=timeout)
+            cls._shared[key] = influx_obj
+
+        await influx_obj.open()
+        return influx_obj
+
+
+    @classmethod
+    async def close_shared(cls):
+        """
+            Close the shared instances of the running event loop.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        for key in [key for key in cls._shared if key[0] is loop]:
+            await cls._shared.pop(key).close()
+
+    #############
+
+    async def get_database_names(self, skip_internal=True):
+
+        try:
+            buckets = await self.buckets_service.get_buckets_async(limit=100)
+        except Exception as E:
+            return False, str(E)
+
+        names = [x.name for x in buckets.buckets]
+
+        if skip_internal:
+            names = [name for name in names if not name.startswith("_")]
+
+        names.sort()
+        return True, names
+
+
+    async def find_bucket(self, bucket_name):
+        """
+            Return (status, Bucket or None).
+        """
+
+        try:
+            buckets = await self.buckets_service.get_buckets_async(name=bucket_name)
+        except Exception as E:
+            return False, f"cannot look up bucket {bucket_name}: {E}"
+
+        return True, buckets.buckets[0] if buckets.buckets else None
+
+
+    async def create_bucket(self, bucket_name, retention_seconds=30*24*60*60):
+        """
+            Create 'bucket_name' unless it exists; 'retention_seconds' of 0 keeps the data forever.
+        """
+
+        status, output = await self.find_bucket(bucket_name)
+        if not status:
+            return False, output
+
+        if output:
+            self.verified_buckets.add(bucket_name)
+            return True, output
+
+        try:
+            if not self.org_id:
+                orgs = await OrganizationsService(self.client.api_client).get_orgs_async(org=self.org)
+                if not orgs.orgs:
+                    return False, f"cannot find organization {self.org}"
+                self.org_id = orgs.orgs[0].id
+
+            retention_rules = BucketRetentionRules(type="expire", every_seconds=retention_seconds)
+            request = PostBucketRequest(name=bucket_name, org_id=self.org_id, retention_rules=[retention_rules])
+            bucket = await self.buckets_service.post_buckets_async(post_bucket_request=request)
+        except Exception as E:
+            return False, f"cannot create bucket {bucket_name}: {E}"
+
+        self.verified_buckets.add(bucket_name)
+        return True, bucket
+
+
+    async def delete_bucket(self, bucket_name):
+
+        self.verified_buckets.discard(bucket_name)
+
+        status, output = await self.find_bucket(bucket_name)
+        if not status:
+            return False, output
+
+        if not output:
+            return True, None
+
+        try:
+            await self.buckets_service.delete_buckets_id_async(output.id)
+        except Exception as E:
+            return False, f"cannot delete bucket {bucket_name}: {E}"
+
+        return True, None
+
+    #############
+
+    async def write_data(self, data_list, database_name):
+        """
+            Write points (line protocol strings and/or point dictionaries), see InfluxDB_Access.write_data().
+        """
+
+        if not data_list:
+            return False, "write_data: data_list is empty"
+
+        data_list = InfluxDB_Access.prepare_data(data_list)
+
+        if not data_list:
+            log.warning("write_data: data to write is empty")
+            return True, None
+
+        if database_name not in self.verified_buckets:
+            status, output = await self.create_bucket(database_name)
+            if not status:
+                return False, output
+
+        try:
+            await self.write_api.write(bucket=database_name, record=data_list)
+        except Exception as E:
+            # the bucket might have been deleted behind our back
+            self.verified_buckets.discard(database_name)
+            return False, f"cannot write to bucket {database_name}: {E}"
+
+        if InfluxDB_Access.query_cache:
+            InfluxDB_Access.query_cache.invalidate_points(data_list, database_name)
+
+        return True, None
+
+    #############
+
+    async def read_data(self, query, omit_boilerplate_col=True):
+        """
+            Run a query and return {table: {record: entry}}, like InfluxDB_Access.read_data().
+        """
+
+        status, output = await self.__query_stream(query)
+        if not status:
+            return False, output
+
+        skip_cols = self.boilerplate_cols if omit_boilerplate_col else frozenset()
+
+        data_dict = {}
+
+        # (result, table) -> running table number, as every yield() numbers its tables from 0
+        table_nums = {}
+
+        # table number -> records seen so far in that table
+        record_nums = {}
+
+        try:
+            async for record in output:
+
+                table_key = (record.values.get("result", None), record.values.get("table", record.table))
+                table_num = table_nums.get(table_key, None)
+                if table_num is None:
+                    table_num = table_nums[table_key] = len(table_nums)
+                record_num = record_nums.get(table_num, 0)
+                record_nums[table_num] = record_num + 1
+
+                entry = {key: val for key, val in record.values.items() if key not in skip_cols}
+
+                if entry:
+                    utility.add_key(data_dict, [table_num, record_num], entry)
+        except Exception as E:
+            return False, f"query failed: {E}"
+
+        return True, data_dict
+
+
+    async def stream_data(self, query, omit_boilerplate_col=True, chunk_size=None):
+        """
+            Run a query and return (status, async generator), see InfluxDB_Access.stream_data().
+            Records are parsed as they arrive, while other tasks keep running.
+        """
+
+        status, output = await self.__query_stream(query)
+        if not status:
+            return False, output
+
+        skip_cols = self.boilerplate_cols if omit_boilerplate_col else frozenset()
+        records = self.__flat_records(output, skip_cols)
+
+        if chunk_size:
+            records = self.__chunks(records, chunk_size)
+
+        return True, records
+
+
+    async def __query_stream(self, query):
+
+        query = textwrap.dedent(query)
+        query = query.strip()
+
+        try:
+            return True, await self.query_api.query_stream(query)
+        except Exception as E:
+            return False, f"query failed: {E}"
+
+
+    @staticmethod
+    async def __flat_records(records, skip_cols):
+
+        async for record in records:
+            entry = {key: val for key, val in record.values.items() if key not in skip_cols}
+            if entry:
+                yield entry
+
+
+    @staticmethod
+    async def __chunks(records, chunk_size):
+
+        chunk = []
+
+        async for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    #############
+
+    @staticmethod
+    async def write_points(data_list, url="http://zeus.home", port=8086, database_name="home_sensors", timeout=10_000):
+
+        url_port = f"{url}:{port}"
+
+        try:
+            influx_obj = await InfluxDB_AccessAsync.get_shared(url=url_port, org="home", timeout=timeout)
+            return await influx_obj.write_data(data_list, database_name)
+        except (Exception, SystemExit) as E:
+            return False, f"write_points failed: {E}"
+
+
+    @staticmethod
+    async def read_points(query, url="http://zeus.home", port=8086, timeout=10_000, use_cache=True):
+        """
+            Results are cached in InfluxDB_Access.query_cache, shared with
+            InfluxDB_Access.read_points(), so treat them as read-only.
+        """
+
+        url_port = f"{url}:{port}"
+
+        cache = InfluxDB_Access.query_cache if use_cache else None
+        if cache:
+            key = cache.key(query, url_port, None)
+            result = cache.get(key)
+            if result is not None:
+                return True, result
+
+        try:
+            influx_obj = await InfluxDB_AccessAsync.get_shared(url=url_port, org="home", timeout=timeout)
+            status, output = await influx_obj.read_data(query)
+        except (Exception, SystemExit) as E:
+            return False, f"read_points failed: {E}"
+
+        if status and cache:
+            cache.put(key, output)
+
+        return status, output
+
+
+    @staticmethod
+    async def stream_points(query, url="http://zeus.home", port=8086, timeout=10_000, chunk_size=None):
+
+        url_port = f"{url}:{port}"
+
+        try:
+            influx_obj = await InfluxDB_AccessAsync.get_shared(url=url_port, org="home", timeout=timeout)
+            return await influx_obj.stream_data(query, chunk_size=chunk_size)
+        except (Exception, SystemExit) as E:
+            return False, f"stream_points failed: {E}"
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import time
+
+
+class InfluxDB_Schema():
+    """
+        Measurements with their tag and field keys, per bucket, as discovered by
+        InfluxDB_Access.get_schema().
+    """
+
+    def __init__(self, buckets, fetched=None):
+
+        # bucket -> measurement -> {"tags": [...], "fields": [...]}
+        self.buckets = buckets
+        self.fetched = fetched or time.time()
+
+
+    def bucket_names(self):
+
+        return sorted(self.buckets)
+
+
+    def measurements(self, bucket_name):
+
+        return sorted(self.buckets.get(bucket_name, {}))
+
+
+    def tag_keys(self, bucket_name, measurement):
+
+        return self.buckets.get(bucket_name, {}).get(measurement, {}).get("tags", [])
+
+
+    def field_keys(self, bucket_name, measurement):
+
+        return self.buckets.get(bucket_name, {}).get(measurement, {}).get("fields", [])
+
+
+    def rows(self, bucket_name):
+        """
+            [measurement, tag keys, field keys] rows for tabulate.
+        """
+
+        return [
+            [measurement, ', '.join(self.tag_keys(bucket_name, measurement)), ', '.join(self.field_keys(bucket_name, measurement))]
+            for measurement in self.measurements(bucket_name)
+        ]
+
+
+    def to_dict(self):
+
+        return {
+            bucket_name: {measurement: dict(keys) for measurement, keys in measurements.items()}
+            for bucket_name, measurements in self.buckets.items()
+        }
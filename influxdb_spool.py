@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+KIND_JSON = 0
+KIND_LINE = 1
+
+
+class InfluxDB_Spool():
+    """
+        Durable store-and-forward spool for data points that could not be written
+        to InfluxDB, kept in an SQLite database in WAL mode.
+
+        Points are appended in one transaction per batch (never per reading), so the
+        SD card only sees a write when a whole batch fails. The spool is trimmed to
+        'max_points' and 'max_age' seconds (oldest first), and the file is compacted
+        once the backlog has been replayed.
+    """
+
+    def __init__(self, path="influxdb_spool.db", max_points=1_000_000, max_age=7*24*3600):
+
+        self.path = path
+        self.max_points = max_points
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+        # auto_vacuum must be set before the first table is created
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                id      INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                kind    INTEGER NOT NULL,
+                record  TEXT NOT NULL
+            )
+        """)
+
+        self.count = self.conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        if self.count:
+            log.info("InfluxDB_Spool: %d points pending in %s", self.count, path)
+
+
+    def close(self):
+
+        with self.lock:
+            self.conn.close()
+
+
+    def append(self, points):
+
+        now = time.time()
+        rows = []
+
+        for point in points:
+            if isinstance(point, str):
+                rows.append((now, KIND_LINE, point))
+            else:
+                rows.append((now, KIND_JSON, json.dumps(point)))
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("INSERT INTO spool (created, kind, record) VALUES (?, ?, ?)", rows)
+            self.count += len(rows)
+
+        self.trim()
+
+
+    def peek(self, limit):
+        """
+            Return (last_id, points) for up to 'limit' of the oldest spooled points.
+        """
+
+        with self.lock:
+            rows = self.conn.execute("SELECT id, kind, record FROM spool ORDER BY id LIMIT ?",
+                                     (limit,)).fetchall()
+
+        if not rows:
+            return None, []
+
+        points = [record if kind == KIND_LINE else json.loads(record) for _, kind, record in rows]
+
+        return rows[-1][0], points
+
+
+    def remove(self, last_id):
+        """
+            Remove all points up to and including 'last_id' (after a successful replay).
+        """
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+            self.count = self.conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+        if not self.count:
+            self.compact()
+
+
+    def trim(self):
+
+        removed = 0
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+
+                if self.max_age:
+                    cursor = self.conn.execute("DELETE FROM spool WHERE created < ?",
+                                               (time.time() - self.max_age,))
+                    removed += cursor.rowcount
+
+                if self.max_points and self.count - removed > self.max_points:
+                    cursor = self.conn.execute("""
+                        DELETE FROM spool WHERE id IN (
+                            SELECT id FROM spool ORDER BY id LIMIT ?
+                        )
+                    """, (self.count - removed - self.max_points,))
+                    removed += cursor.rowcount
+
+            self.count -= removed
+
+        if removed:
+            log.warning("InfluxDB_Spool: trimmed %d old points", removed)
+
+        return removed
+
+
+    def compact(self):
+        """
+            Give free pages back to the file system and fold the WAL into the database.
+        """
+
+        with self.lock:
+            self.conn.execute("PRAGMA incremental_vacuum")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
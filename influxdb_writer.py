@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+from influxdb_access import InfluxDB_Access
+
+log = logging.getLogger(__name__)
+
+
+class InfluxDB_Writer():
+    """
+        Buffers data points in memory and writes them to InfluxDB in batches
+        from a background thread.
+
+        A batch is flushed when 'batch_size' points are pending, when the oldest
+        pending point is 'flush_interval' seconds old, or both (set either one
+        to None to disable that trigger). The buffer is bounded by 'max_buffer';
+        once full, the oldest points are dropped. Failed writes are retried with
+        jittered exponential backoff, and the remaining points are flushed on stop().
+
+        If a 'spool' (InfluxDB_Spool) is given, batches that still fail after all
+        retries are spooled to disk instead of dropped. The backlog is replayed in
+        bulk batches of 'replay_batch_size', at most one every 'replay_interval'
+        seconds and only while no live batch is due, so replay never starves live writes.
+    """
+
+    def __init__(self,
+                 write_fn=None,
+                 batch_size=500,
+                 flush_interval=10.0,
+                 max_buffer=50_000,
+                 max_retries=5,
+                 retry_base=1.0,
+                 retry_max=60.0,
+                 spool=None,
+                 replay_batch_size=5000,
+                 replay_interval=2.0):
+
+        if not batch_size and not flush_interval:
+            raise ValueError("InfluxDB_Writer: set batch_size, flush_interval or both")
+
+        self.write_fn = write_fn or InfluxDB_Access.write_points
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.spool = spool
+        self.replay_batch_size = replay_batch_size
+        self.replay_interval = replay_interval
+        self.replay_failures = 0
+        self.next_replay = time.monotonic()
+
+        self.buffer = deque(maxlen=max_buffer)
+        self.oldest_ts = None
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+        # optional histogram (anything with observe(seconds)) for the duration of each write request
+        self.latency = None
+
+        self.stats = {
+            "points_queued": 0,
+            "points_written": 0,
+            "points_dropped": 0,
+            "batches_written": 0,
+            "batches_failed": 0,
+            "retries": 0,
+            "points_spooled": 0,
+            "points_replayed": 0
+        }
+
+
+    def start(self):
+
+        if self.thread:
+            return
+
+        self.stopping = False
+        self.thread = threading.Thread(target=self.__run, name="influxdb-writer", daemon=True)
+        self.thread.start()
+
+
+    def stop(self, timeout=30.0):
+        """
+            Stop the background thread after flushing everything still buffered.
+        """
+
+        if not self.thread:
+            return
+
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+        self.thread.join(timeout)
+        self.thread = None
+
+
+    def write(self, data):
+        """
+            Queue one data point (or a list of them) for writing. Never blocks on I/O.
+        """
+
+        if not isinstance(data, list):
+            data = [data]
+
+        with self.cond:
+
+            # the deque silently discards the oldest points once it is full
+            overflow = len(self.buffer) + len(data) - self.buffer.maxlen
+            if overflow > 0:
+                self.stats["points_dropped"] += overflow
+
+            self.buffer.extend(data)
+            self.stats["points_queued"] += len(data)
+
+            if self.oldest_ts is None:
+                self.oldest_ts = time.monotonic()
+
+            if self.batch_size and len(self.buffer) >= self.batch_size:
+                self.cond.notify()
+
+
+    def pending(self):
+
+        with self.cond:
+            return len(self.buffer)
+
+    #############
+
+    def __run(self):
+
+        while True:
+
+            with self.cond:
+
+                while not self.stopping and not self.__flush_due() and not self.__replay_due():
+                    self.cond.wait(self.__wait_time())
+
+                stopping = self.stopping
+                batch = None
+                if stopping or self.__flush_due():
+                    batch = self.__take_batch()
+
+            if batch:
+                self.__write_batch(batch)
+                continue
+
+            if stopping:
+                return
+
+            self.__replay()
+
+
+    def __flush_due(self):
+
+        if not self.buffer:
+            return False
+
+        if self.batch_size and len(self.buffer) >= self.batch_size:
+            return True
+
+        if self.flush_interval and time.monotonic() - self.oldest_ts >= self.flush_interval:
+            return True
+
+        return False
+
+
+    def __replay_due(self):
+
+        return bool(self.spool and self.spool.count and time.monotonic() >= self.next_replay)
+
+
+    def __wait_time(self):
+
+        wait = None
+
+        if self.flush_interval:
+            wait = self.flush_interval
+            if self.oldest_ts is not None and self.buffer:
+                wait = max(0.0, self.flush_interval - (time.monotonic() - self.oldest_ts))
+
+        if self.spool and self.spool.count:
+            replay_wait = max(0.0, self.next_replay - time.monotonic())
+            wait = replay_wait if wait is None else min(wait, replay_wait)
+
+        return wait
+
+
+    def __take_batch(self):
+
+        count = len(self.buffer)
+        if self.batch_size:
+            count = min(count, self.batch_size)
+
+        batch = [self.buffer.popleft() for _ in range(count)]
+
+        if not self.buffer:
+            self.oldest_ts = None
+
+        return batch
+
+
+    def __write_batch(self, batch):
+
+        attempt = 0
+
+        while True:
+
+            status, output = self.__timed_write(batch)
+            if status:
+                self.stats["points_written"] += len(batch)
+                self.stats["batches_written"] += 1
+                return True
+
+            attempt += 1
+            if attempt > self.max_retries:
+                break
+
+            self.stats["retries"] += 1
+
+            # full jitter: spread retries of many collectors over the backoff window
+            backoff = min(self.retry_max, self.retry_base * (2 ** (attempt - 1)))
+            delay = random.uniform(0, backoff)
+
+            log.warning("InfluxDB_Writer: write failed (%s), retry %d/%d in %.1fs",
+                        output, attempt, self.max_retries, delay)
+
+            with self.cond:
+                if self.stopping:
+                    # do not hold up a shutdown with long backoff sleeps
+                    self.cond.wait(min(delay, 1.0))
+                else:
+                    self.cond.wait_for(lambda: self.stopping, timeout=delay)
+
+        self.stats["batches_failed"] += 1
+
+        if self.spool:
+            try:
+                self.spool.append(batch)
+                self.stats["points_spooled"] += len(batch)
+                log.error("InfluxDB_Writer: spooled %d points: %s", len(batch), output)
+                self.__postpone_replay()
+                return False
+            except Exception as E:
+                log.error("InfluxDB_Writer: cannot spool points: %s", E)
+
+        self.stats["points_dropped"] += len(batch)
+        log.error("InfluxDB_Writer: dropping %d points: %s", len(batch), output)
+        return False
+
+
+    def __timed_write(self, points):
+
+        if not self.latency:
+            return self.write_fn(points)
+
+        start = time.perf_counter()
+        try:
+            return self.write_fn(points)
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+
+
+    def __replay(self):
+
+        try:
+            last_id, points = self.spool.peek(self.replay_batch_size)
+        except Exception as E:
+            log.error("InfluxDB_Writer: cannot read spool: %s", E)
+            self.__postpone_replay()
+            return
+
+        if not points:
+            return
+
+        status, output = self.__timed_write(points)
+        if not status:
+            log.warning("InfluxDB_Writer: replay of %d spooled points failed: %s", len(points), output)
+            self.__postpone_replay()
+            return
+
+        self.spool.remove(last_id)
+        self.stats["points_replayed"] += len(points)
+        self.replay_failures = 0
+        self.next_replay = time.monotonic() + self.replay_interval
+
+        log.info("InfluxDB_Writer: replayed %d spooled points, %d left", len(points), self.spool.count)
+
+
+    def __postpone_replay(self):
+
+        self.replay_failures += 1
+        backoff = min(self.retry_max, self.replay_interval * (2 ** self.replay_failures))
+        self.next_replay = time.monotonic() + random.uniform(backoff / 2, backoff)
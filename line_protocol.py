@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import time
+import socket
+import getpass
+
+# https://docs.influxdata.com/influxdb/v2.7/reference/syntax/line-protocol/#special-characters
+_ESCAPE_MEASUREMENT = str.maketrans({",": r"\,", " ": r"\ ", "\n": r"\n"})
+_ESCAPE_KEY = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n"})
+_ESCAPE_STRING = str.maketrans({'"': r'\"', "\\": r"\\"})
+
+
+def escape_measurement(value):
+
+    return str(value).translate(_ESCAPE_MEASUREMENT)
+
+
+def escape_key(value):
+
+    return str(value).translate(_ESCAPE_KEY)
+
+
+def escape_string(value):
+
+    return str(value).translate(_ESCAPE_STRING)
+
+
+def encode_fields(fields):
+    """
+        Encode a field set the way influxdb_client does: ints get the 'i' suffix,
+        strings are quoted, None values are skipped.
+    """
+
+    parts = []
+
+    for key, value in fields.items():
+
+        if value is None:
+            continue
+
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        elif isinstance(value, int):
+            value = f"{value}i"
+        elif isinstance(value, float):
+            value = repr(value)
+        else:
+            value = f'"{escape_string(value)}"'
+
+        parts.append(f"{escape_key(key)}={value}")
+
+    return ",".join(parts)
+
+
+class LineProtocolEncoder():
+    """
+        Encodes sensor readings as InfluxDB line protocol.
+
+        The escaped series prefix ('measurement,tag=value,...') is built once per
+        sensor and cached, so encoding a reading only appends its field set and
+        an integer nanosecond timestamp (taken at reception, not at forwarding).
+    """
+
+    def __init__(self, measurement="ble_sensor", static_tags=None):
+
+        self.measurement = escape_measurement(measurement)
+
+        if static_tags is None:
+            static_tags = {
+                "hostname": socket.gethostname(),  # collector hostname
+                "username": getpass.getuser()      # collector username
+            }
+
+        self.static_tags = static_tags
+
+        # series key -> "measurement,tag=value,... "
+        self.prefixes = {}
+
+        # (epoch second, formatted local time) for the 'timestamp' field
+        self.last_second = (None, None)
+
+
+    def series_prefix(self, key, tags):
+        """
+            Return the cached prefix for 'key', building it from 'tags' the first time.
+            Tags are sorted by key, as recommended for write performance.
+        """
+
+        prefix = self.prefixes.get(key, None)
+
+        if prefix is None:
+
+            all_tags = dict(self.static_tags)
+            all_tags.update(tags)
+
+            tag_set = "".join(
+                f",{escape_key(tag)}={escape_key(value)}"
+                for tag, value in sorted(all_tags.items())
+                if value is not None and value != ""
+            )
+
+            prefix = self.prefixes[key] = f"{self.measurement}{tag_set} "
+
+        return prefix
+
+
+    def encode(self, key, tags, fields, ts_ns):
+
+        return f"{self.series_prefix(key, tags)}{encode_fields(fields)} {ts_ns}"
+
+
+    def encode_reading(self, reading, sensor, extra_fields=None):
+        """
+            Encode a sensor_collector.SensorReading; 'sensor' is its registry entry
+            (name, location, mac_address). The field set matches SensorReading.to_dict(),
+            plus 'extra_fields' if given.
+        """
+
+        name = sensor.get("name", None)
+        location = sensor.get("location", None)
+
+        prefix = self.prefixes.get((reading.mac_raw, name, location), None)
+        if prefix is None:
+            prefix = self.series_prefix((reading.mac_raw, name, location), {
+                "sensor_name": name,
+                "sensor_location": location,
+                "sensor_mac": reading.mac_address
+            })
+
+        return (f'{prefix}timestamp="{self.__timestamp(reading.ts_ns)}"'
+                f",temperature={round(reading.temperature, 2)!r}"
+                f",humidity={reading.humidity}i"
+                f",battery_level={float(reading.battery_level)!r}"
+                f",battery_voltage={round(reading.battery_voltage, 3)!r}"
+                f",frame_counter={reading.frame_counter}i"
+                f",rssi={reading.rssi}i"
+                f",distance={reading.distance!r}"
+                f",measurement_interval={round(reading.measurement_interval, 2)!r}"
+                f"{',' + encode_fields(extra_fields) if extra_fields else ''}"
+                f" {reading.ts_ns}")
+
+
+    def __timestamp(self, ts_ns):
+
+        second = ts_ns // 1_000_000_000
+
+        if second != self.last_second[0]:
+            self.last_second = (second, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second)))
+
+        return self.last_second[1]
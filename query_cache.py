@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import re
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+_WHITESPACE = re.compile(r"\s+")
+_COMMENT = re.compile(r"//[^\n]*")
+_BUCKET = re.compile(r'from\(\s*bucket\s*:\s*"((?:[^"\\]|\\.)*)"')
+_RANGE = re.compile(r"range\(\s*start\s*:\s*([^,)]+?)\s*(?:,\s*stop\s*:\s*([^,)]+?)\s*)?\)")
+_RFC3339 = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})$")
+
+# r.tag == "value" or r["tag"] == "value"
+_TAG_FILTER = re.compile(r'r(?:\.(\w+)|\[\s*"((?:[^"\\]|\\.)*)"\s*\])\s*==\s*"((?:[^"\\]|\\.)*)"')
+
+# tags that identify a sensor (see line_protocol.LineProtocolEncoder.encode_reading)
+SENSOR_TAGS = ("sensor_name", "sensor_location", "sensor_mac")
+
+# unescaped separators of a line protocol series key
+_LP_SPACE = re.compile(r"(?<!\\) ")
+_LP_COMMA = re.compile(r"(?<!\\),")
+_LP_EQUALS = re.compile(r"(?<!\\)=")
+_LP_UNESCAPE = re.compile(r"\\(.)")
+
+
+def normalize_query(query):
+    """
+        Collapse whitespace and drop comments outside of string literals, so
+        queries that only differ in formatting share a cache entry.
+    """
+
+    parts = []
+    last = 0
+
+    for match in _STRING.finditer(query):
+        code = _COMMENT.sub("", query[last:match.start()])
+        parts.append(_WHITESPACE.sub(" ", code))
+        parts.append(match.group(0))
+        last = match.end()
+
+    parts.append(_WHITESPACE.sub(" ", _COMMENT.sub("", query[last:])))
+    return "".join(parts).strip()
+
+
+def parse_time(value):
+    """
+        Epoch ns of an RFC3339 literal, or None for anything relative (durations, now(), ...).
+    """
+
+    if not _RFC3339.match(value):
+        return None
+
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+    return int(dt.timestamp()) * 1_000_000_000 + dt.microsecond * 1000
+
+
+def parse_series_key(line):
+    """
+        (measurement, {tag: value}, timestamp in ns or None) of a line protocol line.
+    """
+
+    parts = _LP_SPACE.split(line.strip())
+    key = _LP_COMMA.split(parts[0])
+
+    tags = {}
+    for tag in key[1:]:
+        pair = _LP_EQUALS.split(tag, 1)
+        if len(pair) == 2:
+            tags[_LP_UNESCAPE.sub(r"\1", pair[0])] = _LP_UNESCAPE.sub(r"\1", pair[1])
+
+    ts = None
+    if len(parts) >= 3 and parts[-1].lstrip("-").isdigit():
+        ts = int(parts[-1])
+
+    return _LP_UNESCAPE.sub(r"\1", key[0]), tags, ts
+
+
+class CacheEntry():
+
+    __slots__ = ("result", "size", "expires", "bucket", "start", "stop", "tag_filters")
+
+    def __init__(self, result, size, expires, bucket, start, stop, tag_filters):
+
+        self.result = result
+        self.size = size
+        self.expires = expires          # monotonic time, None = never
+        self.bucket = bucket
+        self.start = start              # epoch ns, None if relative
+        self.stop = stop
+        self.tag_filters = tag_filters  # {tag: {values}} for sensor tags, empty = all sensors
+
+
+class QueryCache():
+    """
+        LRU cache of query results, keyed on the normalized query text.
+
+        Queries over an absolute time range that lies entirely in the past never
+        expire (their result cannot change, short of a write into that range);
+        all other queries expire after 'ttl_seconds'. Entries are evicted least
+        recently used first once there are more than 'max_entries' of them or
+        more than 'max_records' records in total.
+
+        invalidate_points() is called with every batch the process writes and
+        drops the entries whose bucket, sensor tag filters and time range could
+        include one of the written points.
+    """
+
+    def __init__(self, ttl_seconds=10.0, max_entries=128, max_records=500_000):
+
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_records = max_records
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.records = 0
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evicted": 0,
+            "invalidated": 0
+        }
+
+
+    def key(self, query, *extra):
+
+        return (normalize_query(query),) + extra
+
+
+    def get(self, key):
+
+        with self.lock:
+
+            entry = self.entries.get(key, None)
+
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            if entry.expires is not None and time.monotonic() >= entry.expires:
+                self.__remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry.result
+
+
+    def put(self, key, result):
+
+        query = key[0]
+        size = self.__size(result)
+        if size > self.max_records:
+            return
+
+        bucket = _BUCKET.search(query)
+        bucket = bucket.group(1) if bucket else None
+
+        start, stop = self.__time_range(query)
+
+        expires = None
+        if start is None or stop is None or stop > time.time_ns():
+            start = stop = None
+            expires = time.monotonic() + self.ttl_seconds
+
+        tag_filters = {}
+        for attr_tag, item_tag, value in _TAG_FILTER.findall(query):
+            tag = attr_tag or item_tag
+            if tag in SENSOR_TAGS:
+                tag_filters.setdefault(tag, set()).add(value)
+
+        with self.lock:
+
+            if key in self.entries:
+                self.__remove(key)
+
+            self.entries[key] = CacheEntry(result, size, expires, bucket, start, stop, tag_filters)
+            self.records += size
+
+            while len(self.entries) > self.max_entries or self.records > self.max_records:
+                self.__remove(next(iter(self.entries)))
+                self.stats["evicted"] += 1
+
+
+    def invalidate_points(self, data_list, bucket_name=None):
+        """
+            Drop the entries that may include any of the points written to 'bucket_name'.
+            'data_list' holds line protocol strings and/or point dictionaries.
+        """
+
+        if not self.entries:
+            return
+
+        # series -> (tags, oldest ts, newest ts); a batch holds few distinct series
+        series = {}
+
+        for data in data_list:
+
+            if isinstance(data, str):
+                key = _LP_SPACE.split(data, 1)[0]
+                ts = data.rsplit(" ", 1)[-1]
+                ts = int(ts) if ts.lstrip("-").isdigit() else None
+                if key in series:
+                    tags, oldest, newest = series[key]
+                else:
+                    tags = parse_series_key(key)[1]
+                    oldest = newest = None
+            else:
+                tags = {tag: str(value) for tag, value in (data.get("tags", None) or {}).items()}
+                key = tuple(sorted(tags.items()))
+                ts = data.get("time", None)
+                ts = ts if isinstance(ts, int) else None
+                oldest, newest = series.get(key, (None, None, None))[1:]
+
+            # points without a timestamp get the server time (now)
+            ts = ts if ts is not None else time.time_ns()
+            oldest = ts if oldest is None else min(oldest, ts)
+            newest = ts if newest is None else max(newest, ts)
+            series[key] = (tags, oldest, newest)
+
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if self.__affected(entry, bucket_name, series.values()):
+                    self.__remove(key)
+                    self.stats["invalidated"] += 1
+
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.records = 0
+
+    #############
+
+    def __remove(self, key):
+
+        entry = self.entries.pop(key)
+        self.records -= entry.size
+
+
+    @staticmethod
+    def __affected(entry, bucket_name, series):
+
+        if entry.bucket and bucket_name and entry.bucket != bucket_name:
+            return False
+
+        for tags, oldest, newest in series:
+
+            if entry.start is not None and (newest < entry.start or oldest >= entry.stop):
+                continue
+
+            if all(tags.get(tag, None) in values for tag, values in entry.tag_filters.items()):
+                return True
+
+        return False
+
+
+    @staticmethod
+    def __time_range(query):
+        """
+            (start, stop) in epoch ns covering all range() calls, (None, None) if any bound is relative.
+        """
+
+        start = stop = None
+
+        ranges = _RANGE.findall(query)
+        if not ranges:
+            return None, None
+
+        for range_start, range_stop in ranges:
+
+            range_start = parse_time(range_start)
+            range_stop = parse_time(range_stop) if range_stop else None
+
+            if range_start is None or range_stop is None:
+                return None, None
+
+            start = range_start if start is None else min(start, range_start)
+            stop = range_stop if stop is None else max(stop, range_stop)
+
+        return start, stop
+
+
+    @staticmethod
+    def __size(result):
+
+        if isinstance(result, dict):
+            # {table: {record: entry}} counts records, columnar results count rows
+            if all(isinstance(value, dict) for value in result.values()):
+                return sum(len(value) for value in result.values())
+            return max((len(value) for value in result.values()), default=0)
+
+        return getattr(result, "num_rows", 1)
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import time
+import socket
+import random
+import asyncio
+import logging
+from collections import deque
+
+import sensor_collector
+import wire_format
+from frame_dedup import FrameDedup
+from influxdb_writer import InfluxDB_Writer
+from line_protocol import LineProtocolEncoder
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9555
+
+# keep UDP datagrams below a typical Ethernet/WiFi MTU
+MAX_DATAGRAM = 1400
+
+# frames per batch on TCP
+MAX_BATCH = 4096
+
+
+class FrameCopies():
+    """
+        All copies of one frame (MAC, frame counter) heard so far by the collectors.
+    """
+
+    __slots__ = ("payload", "rssi", "ts_ns", "collector", "collectors", "deadline")
+
+    def __init__(self, collector, payload, rssi, ts_ns, deadline):
+
+        self.payload = payload
+        self.rssi = rssi
+        self.ts_ns = ts_ns
+        self.collector = collector
+        self.collectors = {collector}
+        self.deadline = deadline
+
+
+class SensorAggregator():
+    """
+        Central endpoint for a multiple collector setup.
+
+        Collectors stream raw frames (payload, RSSI, reception time) in
+        wire_format batches over TCP or UDP. The first copy of a frame opens a
+        hold window of 'hold_seconds'; copies heard by other collectors within
+        that window are merged into it, keeping the one with the best RSSI. When the window closes, the frame is
+        decoded once and written to InfluxDB with the best collector as the
+        'hostname' tag and the list of collectors that heard it as a field.
+        Copies arriving later than that are dropped for 'ttl_seconds'.
+
+        Writes go through one InfluxDB_Writer with large batches, so neither
+        Redis nor InfluxDB see per-collector traffic.
+    """
+
+    def __init__(self,
+                 host="0.0.0.0",
+                 port=DEFAULT_PORT,
+                 udp_port=DEFAULT_PORT,
+                 hold_seconds=1.0,
+                 ttl_seconds=2*60,
+                 writer=None,
+                 measurement="ble_sensor"):
+
+        self.host = host
+        self.port = port
+        self.udp_port = udp_port
+        self.hold_seconds = hold_seconds
+        self.measurement = measurement
+
+        self.writer = writer or InfluxDB_Writer(batch_size=5000, flush_interval=5.0)
+
+        # (mac_raw, frame_counter) -> FrameCopies, in arrival order (so also in deadline order)
+        self.pending = {}
+
+        # frames already written, so late copies are not written twice
+        self.frame_dedup = FrameDedup(ttl_seconds=ttl_seconds)
+
+        # collector -> LineProtocolEncoder tagged with that collector
+        self.encoders = {}
+
+        # collector -> {"frames": heard, "best": written with its copy, "last_seen": epoch seconds}
+        self.collectors = {}
+
+        self.stats = {
+            "frames_received": 0,
+            "copies_merged": 0,
+            "late_copies": 0,
+            "readings_written": 0,
+            "bad_records": 0
+        }
+
+
+    async def serve(self):
+        """
+            Accept collector streams until cancelled, then write out the frames still on hold.
+        """
+
+        loop = asyncio.get_running_loop()
+        servers = []
+
+        if self.port:
+            server = await asyncio.start_server(self.__handle_tcp, self.host, self.port)
+            servers.append(server)
+
+        if self.udp_port:
+            transport, _ = await loop.create_datagram_endpoint(lambda: AggregatorDatagramProtocol(self),
+                                                               local_addr=(self.host, self.udp_port))
+            servers.append(transport)
+
+        print(f"Aggregator listening on {self.host} (tcp: {self.port or '-'}, udp: {self.udp_port or '-'})")
+
+        try:
+            while True:
+                await asyncio.sleep(self.hold_seconds / 4)
+                self.flush(time.monotonic())
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        finally:
+            for server in servers:
+                server.close()
+            self.flush()
+
+
+    def receive(self, collector, payload, rssi, ts_ns):
+
+        if len(payload) < sensor_collector.PAYLOAD_STRUCT.size:
+            self.stats["bad_records"] += 1
+            return
+
+        self.stats["frames_received"] += 1
+
+        info = self.collectors.get(collector, None)
+        if info is None:
+            info = self.collectors[collector] = {"frames": 0, "best": 0, "last_seen": 0.0}
+        info["frames"] += 1
+        info["last_seen"] = time.time()
+
+        # the payload starts with the MAC address and ends with the frame counter
+        key = (payload[:6], payload[12])
+
+        copies = self.pending.get(key, None)
+        if copies is not None:
+            self.stats["copies_merged"] += 1
+            copies.collectors.add(collector)
+            if rssi > copies.rssi:
+                copies.rssi = rssi
+                copies.collector = collector
+            copies.ts_ns = min(copies.ts_ns, ts_ns)
+            return
+
+        if self.frame_dedup.is_duplicate(key[0], key[1]):
+            self.stats["late_copies"] += 1
+            return
+
+        self.pending[key] = FrameCopies(collector, payload, rssi, ts_ns, time.monotonic() + self.hold_seconds)
+
+
+    def flush(self, now=None):
+        """
+            Write the frames whose hold window ended before 'now' (monotonic), or all of them.
+        """
+
+        while self.pending:
+
+            key = next(iter(self.pending))
+            copies = self.pending[key]
+            if now is not None and copies.deadline > now:
+                break
+
+            del self.pending[key]
+            self.__write(copies)
+
+
+    def collector_stats(self):
+        """
+            Per collector: frames heard, frames written with its copy (best RSSI) and last seen time.
+        """
+
+        return {collector: dict(info) for collector, info in self.collectors.items()}
+
+    #############
+
+    def __write(self, copies):
+
+        try:
+            reading = sensor_collector.decode_payload(copies.payload, copies.rssi, copies.ts_ns)
+        except Exception as E:
+            log.error("SensorAggregator: cannot decode frame: %s", E)
+            self.stats["bad_records"] += 1
+            return
+
+        encoder = self.encoders.get(copies.collector, None)
+        if encoder is None:
+            encoder = self.encoders[copies.collector] = LineProtocolEncoder(self.measurement,
+                                                                            static_tags={"hostname": copies.collector})
+
+        sensor = sensor_collector.registry.lookup_raw(reading.mac_raw) or {}
+        self.writer.write(encoder.encode_reading(reading, sensor, {
+            "collectors": ",".join(sorted(copies.collectors)),
+            "collector_count": len(copies.collectors)
+        }))
+
+        self.collectors[copies.collector]["best"] += 1
+        self.stats["readings_written"] += 1
+
+
+    async def __handle_tcp(self, reader, writer):
+
+        peer = writer.get_extra_info("peername")
+        log.info("SensorAggregator: collector connected from %s", peer)
+
+        try:
+            while True:
+                batch = await wire_format.read_batch(reader)
+                if batch is None:
+                    break
+                self.receive_batch(*batch)
+        except wire_format.WireFormatError as E:
+            # the stream cannot be resynchronized, the collector reconnects
+            log.error("SensorAggregator: bad batch from %s: %s", peer, E)
+            self.stats["bad_records"] += 1
+        except (ConnectionError, asyncio.IncompleteReadError) as E:
+            log.warning("SensorAggregator: connection from %s lost: %s", peer, E)
+        finally:
+            writer.close()
+
+
+    def receive_datagram(self, data):
+
+        try:
+            collector, frames = wire_format.decode_batch(data)
+        except wire_format.WireFormatError:
+            self.stats["bad_records"] += 1
+            return
+
+        self.receive_batch(collector, frames)
+
+
+    def receive_batch(self, collector, frames):
+
+        for payload, rssi, ts_ns in frames:
+            self.receive(collector, payload, rssi, ts_ns)
+
+
+class AggregatorDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, aggregator):
+
+        self.aggregator = aggregator
+
+
+    def datagram_received(self, data, addr):
+
+        self.aggregator.receive_datagram(data)
+
+
+class AggregatorClient():
+    """
+        Streams the frames of this collector to a SensorAggregator.
+
+        send() only appends the frame to a bounded buffer (the oldest frames are
+        dropped when it is full); a background task started on first use sends
+        the buffer every 'flush_interval' seconds as wire_format batches
+        (zlib-compressed if 'compress') and reconnects with exponential backoff
+        if the aggregator is unreachable. 'transport' is "tcp" or "udp" (fire
+        and forget, one batch per datagram).
+    """
+
+    def __init__(self,
+                 host,
+                 port=DEFAULT_PORT,
+                 collector_id=None,
+                 transport="tcp",
+                 max_buffer=10_000,
+                 flush_interval=0.05,
+                 retry_max=30.0,
+                 compress=False):
+
+        if transport not in ("tcp", "udp"):
+            raise ValueError(f"invalid transport '{transport}' (tcp or udp)")
+
+        self.host = host
+        self.port = port
+        self.collector_id = collector_id or socket.gethostname()
+        self.transport = transport
+        self.flush_interval = flush_interval
+        self.retry_max = retry_max
+        self.compress = compress
+
+        # (payload, rssi, ts_ns)
+        self.buffer = deque(maxlen=max_buffer)
+        self.task = None
+
+        self.stats = {
+            "frames_sent": 0,
+            "frames_dropped": 0,
+            "bytes_sent": 0,
+            "reconnects": 0
+        }
+
+
+    def send(self, reading):
+
+        if len(self.buffer) == self.buffer.maxlen:
+            self.stats["frames_dropped"] += 1
+
+        self.buffer.append((reading.to_payload(), reading.rssi, reading.ts_ns))
+
+        # (re)start the sender if it is not running
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.__run())
+
+
+    async def stop(self, timeout=5.0):
+        """
+            Give the sender up to 'timeout' seconds to send the buffered frames, then stop it.
+        """
+
+        if self.task:
+            deadline = time.monotonic() + timeout
+            while self.buffer and not self.task.done() and time.monotonic() < deadline:
+                await asyncio.sleep(self.flush_interval)
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    #############
+
+    async def __run(self):
+
+        delay = 1.0
+
+        while True:
+
+            try:
+                await self.__stream()
+            except asyncio.CancelledError:
+                raise
+            except OSError as E:
+                log.warning("AggregatorClient: %s:%s unreachable: %s (retry in %.1fs)", self.host, self.port, E, delay)
+            except Exception as E:
+                log.error("AggregatorClient: streaming to %s:%s failed: %s (retry in %.1fs)", self.host, self.port, E, delay)
+
+            self.stats["reconnects"] += 1
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, self.retry_max)
+
+
+    async def __stream(self):
+
+        loop = asyncio.get_running_loop()
+
+        if self.transport == "tcp":
+            _, writer = await asyncio.open_connection(self.host, self.port)
+        else:
+            writer, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                            remote_addr=(self.host, self.port))
+
+        log.info("AggregatorClient: streaming to %s:%s over %s", self.host, self.port, self.transport)
+
+        try:
+            while True:
+
+                await asyncio.sleep(self.flush_interval)
+
+                if not self.buffer:
+                    continue
+
+                # no await until the buffer is cleared: the frames leave it only once
+                # they are encoded and handed to the transport
+                frames = list(self.buffer)
+
+                try:
+                    batches = self.__batches(frames, MAX_BATCH if self.transport == "tcp" else self.udp_batch_size())
+                except wire_format.WireFormatError as E:
+                    log.error("AggregatorClient: dropping %d frames that cannot be encoded: %s", len(frames), E)
+                    self.buffer.clear()
+                    self.stats["frames_dropped"] += len(frames)
+                    continue
+
+                if self.transport == "tcp":
+                    writer.write(b"".join(batches))
+                    self.buffer.clear()
+                    try:
+                        await writer.drain()
+                    except (OSError, asyncio.CancelledError):
+                        # put the frames back, the aggregator drops the ones it already got
+                        self.__requeue(frames)
+                        raise
+                else:
+                    for batch in batches:
+                        writer.sendto(batch)
+                    self.buffer.clear()
+
+                self.stats["frames_sent"] += len(frames)
+                self.stats["bytes_sent"] += sum(len(batch) for batch in batches)
+        finally:
+            writer.close()
+
+
+    def __requeue(self, frames):
+        """
+            Put unsent 'frames' back in front of the buffer, in order. If frames
+            were sent meanwhile and it overflows, the oldest ones are dropped, as in send().
+        """
+
+        frames = frames + list(self.buffer)
+        overflow = max(0, len(frames) - self.buffer.maxlen)
+
+        self.buffer.clear()
+        self.buffer.extend(frames[overflow:])
+        self.stats["frames_dropped"] += overflow
+
+
+    def udp_batch_size(self):
+        """
+            Frames per datagram, so that an (uncompressed) batch fits in MAX_DATAGRAM.
+        """
+
+        overhead = wire_format.HEADER_STRUCT.size + 1 + len(self.collector_id.encode())
+        return max(1, (MAX_DATAGRAM - overhead) // wire_format.RECORD_STRUCT.size)
+
+
+    def __batches(self, frames, batch_size):
+        """
+            Encode 'frames' in batches of at most 'batch_size' frames, each spanning at
+            most wire_format.MAX_DELTA_NS (frames buffered while the aggregator was
+            unreachable can span hours).
+        """
+
+        batches = []
+        start = 0
+        oldest = newest = None
+
+        for i, (_, _, ts_ns) in enumerate(frames):
+
+            if oldest is not None:
+                if i - start >= batch_size or max(newest, ts_ns) - min(oldest, ts_ns) > wire_format.MAX_DELTA_NS:
+                    batches.append(wire_format.encode_batch(frames[start:i], self.collector_id, self.compress))
+                    start = i
+                    oldest = newest = None
+
+            oldest = ts_ns if oldest is None else min(oldest, ts_ns)
+            newest = ts_ns if newest is None else max(newest, ts_ns)
+
+        if start < len(frames):
+            batches.append(wire_format.encode_batch(frames[start:], self.collector_id, self.compress))
+
+        return batches
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from influxdb_spool import InfluxDB_Spool
+
+    parser = argparse.ArgumentParser(description="Aggregate frames from several collectors into InfluxDB.")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port (0 to disable)")
+    parser.add_argument("--udp-port", type=int, default=DEFAULT_PORT, help="UDP port (0 to disable)")
+    parser.add_argument("--hold", type=float, default=1.0, help="seconds to wait for copies of a frame from other collectors")
+    args = parser.parse_args()
+
+    influx_spool = InfluxDB_Spool("aggregator_spool.db")
+    influx_writer = InfluxDB_Writer(batch_size=5000, flush_interval=5.0, spool=influx_spool)
+
+    aggregator = SensorAggregator(host=args.host,
+                                  port=args.port,
+                                  udp_port=args.udp_port,
+                                  hold_seconds=args.hold,
+                                  writer=influx_writer)
+
+    influx_writer.start()
+
+    try:
+        asyncio.run(aggregator.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        aggregator.flush()
+        print(f"Flushing {influx_writer.pending()} buffered points...")
+        influx_writer.stop()
+        influx_spool.close()
+        print(f"Collectors: {aggregator.collector_stats()}")
@@ -3,77 +3,278 @@
 # Author: Mani Amoozadeh
 # Email: mani.amoozadeh2@gmail.com
 
+import time
 import asyncio
-import datetime
 import socket
-import getpass
-import redis
+import signal
+import redis.asyncio
 
 import sensor_collector
-from influxdb_access import InfluxDB_Access
+import frame_queue
+from influxdb_writer import InfluxDB_Writer
+from influxdb_spool import InfluxDB_Spool
+from frame_dedup import FrameDedup, AsyncRedisDedup
+from line_protocol import LineProtocolEncoder
+from edge_rollup import EdgeRollup
+from deadband import DeadbandFilter
+from collector_metrics import MetricsRegistry, LoopLagMonitor, start_metrics_server
+from collector_profiler import Profiler
 
-redis_h = redis.Redis(host='localhost', port=6379, db=0)
+redis_h = redis.asyncio.Redis(host='localhost', port=6379, db=0)
 
-def handle_sensor_data(data):
+# dedup is answered from memory; Redis is only asked the first time a frame is seen.
+# Redis checks are batched and shared with the other collectors (collector id = hostname).
+frame_dedup = FrameDedup(snapshot_path="dedup_snapshot.json")
+redis_dedup = AsyncRedisDedup(redis_h, collector_id=socket.gethostname())
 
-    if is_duplicate(data):
+# one HTTP request per batch of readings instead of one per reading
+influx_writer = InfluxDB_Writer(batch_size=100, flush_interval=30.0)
+line_encoder = LineProtocolEncoder(measurement="ble_sensor")
+
+# edge aggregation: per-sensor 5-minute rollups (count/min/max/mean/last) go to 'ble_sensor_rollup'.
+# only the rollups are sent, cutting write volume about 5x. set forward_raw to True to also
+# send the raw readings to 'ble_sensor'.
+forward_raw = False
+edge_rollup = EdgeRollup(window_seconds=5*60)
+rollup_encoder = LineProtocolEncoder(measurement="ble_sensor_rollup")
+
+# change-only reporting of raw readings: skip readings within the deadband of the last
+# forwarded one, but write at least one point per sensor every 10 minutes (heartbeat).
+# only takes effect with forward_raw = True; rollups always see every reading.
+# thresholds can be overridden per sensor in sensors.toml. set to None to forward everything.
+deadband = DeadbandFilter(heartbeat_seconds=10*60)
+
+# multiple collector setup: stream frames to a central sensor_aggregator.py instead of
+# checking Redis and writing to InfluxDB from every collector, e.g.,
+# from sensor_aggregator import AggregatorClient
+# aggregator = AggregatorClient("zeus.home", 9555)
+aggregator = None
+
+# Prometheus metrics on http://<collector>:9101/metrics. set to None to disable.
+metrics_port = 9101
+
+# runtime profiling: SIGUSR1 starts a session (stage timers, cProfile, tracemalloc), the
+# next SIGUSR1 writes the results to ./profiles. set to None to remove the stage hooks.
+profiler = Profiler(output_dir="profiles")
+
+async def handle_sensor_data(reading):
+
+    if aggregator:
+        # the aggregator dedups across collectors, only drop our own repeats here
+        if not frame_dedup.is_duplicate(reading.mac_address, reading.frame_counter):
+            aggregator.send(reading)
+        return
+
+    if await is_duplicate(reading):
         return
 
     print(f"\n[+] Received new Data:")
-    for key, value in data.items():
+    for key, value in reading.to_dict().items():
         print(f"      {key}: {value}")
 
-    forward_influxdb(data)
+    forward_influxdb(reading)
+
+
+async def is_duplicate(reading):
+    """
+        Checks if (MAC, Frame Counter) combo has already been seen,
+        by this collector or by any other collector sharing the Redis server.
+    """
+
+    mac_address = reading.mac_address
+    frame_counter = reading.frame_counter
+
+    if frame_dedup.is_duplicate(mac_address, frame_counter):
+        return True
+
+    if not redis_dedup:
+        return False
+
+    # the winner is counted in redis_dedup.winners (see setup_metrics)
+    duplicate, _ = await redis_dedup.check(mac_address, frame_counter)
+    return duplicate
+
+
+def forward_influxdb(reading):
+    """
+        Queue the reading as a line protocol point, timestamped (in ns) at reception.
+        Tags: collector hostname/username and sensor name/location/mac.
+    """
+
+    if forward_raw:
+        sensor = sensor_collector.registry.lookup_raw(reading.mac_raw) or {}
+        if not deadband or deadband.should_forward(reading, sensor):
+            influx_writer.write(line_encoder.encode_reading(reading, sensor))
+
+    if edge_rollup:
+        summary = edge_rollup.add(reading)
+        if summary:
+            forward_rollups([summary])
+        forward_rollups(edge_rollup.expire())
+
+
+def forward_rollups(summaries):
+    """
+        Queue window summaries as line protocol points, timestamped at the window start.
+    """
+
+    for mac_raw, start_ns, fields in summaries:
+
+        sensor = sensor_collector.registry.lookup_raw(mac_raw) or {}
+        tags = {
+            "sensor_name": sensor.get("name", None),
+            "sensor_location": sensor.get("location", None),
+            "sensor_mac": sensor_collector.int_to_mac(int.from_bytes(mac_raw, "big"))
+        }
 
+        key = (mac_raw, tags["sensor_name"], tags["sensor_location"])
+        influx_writer.write(rollup_encoder.encode(key, tags, fields, start_ns))
 
-def is_duplicate(data, ttl_seconds=2*60):
+
+def setup_metrics():
     """
-        Checks if (MAC, Frame Counter) combo has already been seen using Redis.
+        Register the collector metrics. Counters are read from the stats the
+        components keep anyway; only the latency histograms touch the hot path.
     """
 
-    mac_address = data.get("mac_address", None)
-    frame_counter = data.get("frame_counter", None)
+    metrics = MetricsRegistry()
+
+    def scan_stat(key):
+        return lambda: sensor_collector.scan_stats()[key]
+
+    metrics.counter("advertisements", "BLE advertisements delivered by the scanner", scan_stat("advertisements"))
+    metrics.counter("advertisements_filtered", "Advertisements filtered before decoding", lambda: [
+        ({"reason": reason}, sensor_collector.scan_stats()[reason])
+        for reason in ("unknown_device", "not_sensor_data", "repeats")
+    ])
+    metrics.counter("frames_decoded", "Frames decoded", scan_stat("decoded"))
+    metrics.counter("decode_errors", "Frames that could not be decoded", scan_stat("decode_errors"))
+
+    metrics.gauge("frame_queue_depth", "Frames waiting to be decoded",
+                  lambda: sensor_collector.queue_stats().get("depth", 0))
+    metrics.counter("frame_queue_dropped", "Frames shed by the frame queue", lambda: [
+        ({"reason": "oldest"}, sensor_collector.queue_stats().get("dropped_oldest", 0)),
+        ({"reason": "duplicate"}, sensor_collector.queue_stats().get("dropped_duplicate", 0)),
+        ({"reason": "parked"}, sensor_collector.queue_stats().get("dropped_parked", 0))
+    ])
+
+    def dedup_stats(kind):
+        stats = [({"tier": "local"}, frame_dedup.stats["local_hits" if kind == "hits" else "misses"])]
+        if redis_dedup:
+            duplicates = redis_dedup.stats["duplicates"]
+            stats.append(({"tier": "redis"}, duplicates if kind == "hits" else redis_dedup.stats["checks"] - duplicates))
+        return stats
+
+    metrics.counter("dedup_hits", "Frames found to be duplicates", lambda: dedup_stats("hits"))
+    metrics.counter("dedup_misses", "Frames seen for the first time", lambda: dedup_stats("misses"))
+    if redis_dedup:
+        metrics.counter("redis_errors", "Failed Redis dedup calls", lambda: redis_dedup.stats["errors"])
+        metrics.counter("dedup_frames_won", "Frames checked against Redis, by the collector that claimed them first", lambda: [
+            ({"collector": collector}, count) for collector, count in list(redis_dedup.winners.items())
+        ])
+
+    metrics.counter("influxdb_points_written", "Points written to InfluxDB", lambda: influx_writer.stats["points_written"])
+    metrics.counter("influxdb_points_failed", "Points that could not be written", lambda: [
+        ({"outcome": "spooled"}, influx_writer.stats["points_spooled"]),
+        ({"outcome": "dropped"}, influx_writer.stats["points_dropped"])
+    ])
+    metrics.counter("influxdb_retries", "InfluxDB write retries", lambda: influx_writer.stats["retries"])
+    metrics.gauge("influxdb_pending_points", "Points buffered for the next InfluxDB write", influx_writer.pending)
+
+    def last_seen_ages():
+        now = time.time_ns()
+        ages = []
+        for mac_raw, ts_ns in sensor_collector.last_seen().items():
+            sensor = sensor_collector.registry.lookup_raw(mac_raw) or {}
+            labels = {
+                "sensor_name": sensor.get("name", ""),
+                "sensor_location": sensor.get("location", ""),
+                "sensor_mac": sensor_collector.int_to_mac(int.from_bytes(mac_raw, "big"))
+            }
+            ages.append((labels, round((now - ts_ns) / 1e9, 3)))
+        return ages
+
+    metrics.gauge("sensor_last_seen_age_seconds", "Seconds since the last new frame of each sensor", last_seen_ages)
+
+    sensor_collector.decode_latency = metrics.histogram("decode_seconds", "Time to decode one frame")
+    influx_writer.latency = metrics.histogram("influxdb_write_seconds", "Duration of InfluxDB write requests")
+    if redis_dedup:
+        redis_dedup.latency = metrics.histogram("redis_seconds", "Duration of batched Redis dedup calls")
+
+    loop_lag = LoopLagMonitor(metrics.histogram("event_loop_lag_seconds", "Event loop wake-up delay"))
+    metrics.gauge("event_loop_lag_max_seconds", "Largest event loop wake-up delay seen", lambda: loop_lag.max_lag)
+
+    return metrics, loop_lag
+
+
+def setup_profiler():
+    """
+        Wrap the hot path stages with the profiler's timers (idle until SIGUSR1).
+    """
+
+    global is_duplicate, forward_influxdb
+
+    sensor_collector.profiler = profiler
+    is_duplicate = profiler.wrap_async("dedup", is_duplicate)
+    forward_influxdb = profiler.wrap("forward", forward_influxdb)
+    influx_writer.write_fn = profiler.wrap("write", influx_writer.write_fn)
+
+    profiler.install_signal(asyncio.get_running_loop())
+
+
+async def run_collector():
 
-    if not mac_address or not frame_counter:
-        print("Error: mac_address or frame_counter is missing!")
-        return False  # still proceed
+    tasks = []
+    runner = None
 
-    key = f"dedup:{mac_address.upper()}:{frame_counter}"
+    if profiler:
+        setup_profiler()
 
-    # NX = Only set the key if it does not already exist
-    result = redis_h.set(key, 1, nx=True, ex=ttl_seconds)
+    if metrics_port:
+        metrics, loop_lag = setup_metrics()
+        runner = await start_metrics_server(metrics, port=metrics_port)
+        tasks.append(asyncio.create_task(loop_lag.run()))
 
-    if result:
-        return False  # Successfully set, it's a new entry
+    try:
+        # the detection callback already skips re-advertisements of a sensor's last frame,
+        # so queued frames are distinct readings; under load shed the oldest, keep the freshest.
+        # several consumers keep Redis dedup checks in flight together so they get batched.
+        await sensor_collector.scan(queue_policy=frame_queue.DROP_OLDEST, consumers=8)
+    finally:
+        if aggregator:
+            # send what is still buffered
+            await aggregator.stop()
+        for task in tasks:
+            task.cancel()
+        if runner:
+            await runner.cleanup()
 
-    return True  # Key already exists, it's a duplicate
 
+def handle_sigterm(signum, frame):
+    # systemd stops the service with SIGTERM; unwind so buffered points get flushed
+    raise KeyboardInterrupt
 
-def forward_influxdb(data):
 
-    data_ts = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+if __name__ == "__main__":
 
-    sensor_name = data.pop("name", None)
-    sensor_location = data.pop("location", None)
-    sensor_mac = data.pop("mac_address", None)
+    # batches that cannot be written (e.g., Zeus is down) are spooled to disk and replayed later
+    influx_spool = InfluxDB_Spool("influxdb_spool.db")
+    influx_writer.spool = influx_spool
 
-    data_dict = {
-        "measurement": "ble_sensor",
-        "tags": {
-            "hostname": socket.gethostname(),  # collector hostname
-            "username": getpass.getuser(),     # collector username
-            "sensor_name": sensor_name,
-            "sensor_location": sensor_location,
-            "sensor_mac": sensor_mac
-        },
-        "fields": data,
-        "time": data_ts
-    }
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
-    status, output = InfluxDB_Access.write_points(data_dict)
-    if not status:
-        print(f"write_points failed: {output}")
+    sensor_collector.register_callback(handle_sensor_data, raw=True)
 
-sensor_collector.register_callback(handle_sensor_data)
+    influx_writer.start()
 
-asyncio.run(sensor_collector.scan())
+    try:
+        asyncio.run(run_collector())
+    finally:
+        if edge_rollup:
+            forward_rollups(edge_rollup.flush())
+        print(f"Flushing {influx_writer.pending()} buffered points...")
+        influx_writer.stop()
+        influx_spool.close()
+        frame_dedup.save()
+        if profiler:
+            profiler.stop()
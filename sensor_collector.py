@@ -3,134 +3,269 @@
 # Author: Mani Amoozadeh
 # Email: mani.amoozadeh2@gmail.com
 
+import os
+import time
+import struct
+import signal
 import asyncio
 from bleak import BleakScanner
 from datetime import datetime
 
-# add your sensor information here
-sensors_list = [
-    {
-        "name": "sensor1",
-        "location": "bedroom",
-        "mac_address": "A4:C1:38:AA:EA:0D"
-    },
-    {
-        "name": "sensor2",
-        "location": "outside",
-        "mac_address": "A4:C1:38:67:54:2B"
-    },
-    {
-        "name": "sensor3",
-        "location": "living-room",
-        "mac_address": "A4:C1:38:BD:25:BC"
-    },
-    {
-        "name": "sensor4",
-        "location": "daniel-room",
-        "mac_address": "A4:C1:38:06:EB:5B"
-    },
-
-    {
-        "name": "sensor5",
-        "location": "master-bathroom",
-        "mac_address": "A4:C1:38:45:95:6A"
-    },
-    {
-        "name": "sensor6",
-        "location": "daniel-bathroom",
-        "mac_address": "A4:C1:38:20:51:B0"
-    },
-    {
-        "name": "sensor7",
-        "location": "kitchen",
-        "mac_address": "A4:C1:38:61:25:39"
-    },
-    {
-        "name": "sensor8",
-        "location": "entrance",
-        "mac_address": "A4:C1:38:FB:94:3C"
-    }
-]
+import frame_queue
+from frame_queue import FrameQueue
+from ble_capture import CaptureWriter
+from sensor_registry import SensorRegistry, int_to_mac
 
-sensors_dict = {
-    sensor["mac_address"]: sensor for sensor in sensors_list
-}
+# add your sensor information to this file
+SENSORS_FILE = os.getenv("SENSORS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sensors.toml"))
 
-sensors_mac_address = set(sensors_dict.keys())
+registry = SensorRegistry(SENSORS_FILE)
 
 # Environmental Sensing UUID
 UUID_ENV_SENSING = "0000181a-0000-1000-8000-00805f9b34fb"
 
 _data_callbacks = []
+_frame_queue = None
+
+# mac (raw bytes) -> [ts_ns, frame_counter, measured_interval]
 frame_count_dict = {}
 
+# mac (int) -> [last raw payload, repeats of it skipped, last rssi]
+last_frame_dict = {}
+
+# custom firmware payload: mac (6s), temperature x10 (int16), humidity (uint8),
+# battery level (uint8), battery voltage in mV (uint16), frame counter (uint8)
+PAYLOAD_STRUCT = struct.Struct(">6shBBHB")
+
+# raw mac bytes -> "A4:C1:38:AA:EA:0D"
+_mac_names = {}
+
+# hot path counters (see scan_stats())
+_scan_stats = {
+    "advertisements": 0,     # delivered by the scanner
+    "unknown_device": 0,     # filtered: not a registered sensor
+    "not_sensor_data": 0,    # filtered: no 0x181A service data
+    "repeats": 0,            # filtered: same payload as the last frame
+    "decoded": 0,
+    "decode_errors": 0
+}
+
+# optional histogram (anything with observe(seconds)) for the decode time of each frame
+decode_latency = None
+
+# optional collector_profiler.Profiler timing the detection callback and decoding
+profiler = None
 
-def parse_custom_payload(data, advertisement_data):
+
+class SensorReading():
     """
-        Parses the custom advertisement payload according to the firmware spec.
+        Compact decoded advertisement. Converted to the dictionary handed to
+        callbacks only by to_dict().
     """
 
-    if len(data) < 13:
-        return None  # Payload too short to parse
+    __slots__ = (
+        "mac_raw",
+        "temperature",
+        "humidity",
+        "battery_level",
+        "battery_voltage",
+        "frame_counter",
+        "rssi",
+        "distance",
+        "measurement_interval",
+        "ts_ns"
+    )
 
-    ts = datetime.now()
+    def __init__(self, mac_raw, temperature, humidity, battery_level, battery_voltage,
+                 frame_counter, rssi, distance, measurement_interval, ts_ns):
 
-    try:
+        self.mac_raw = mac_raw
+        self.temperature = temperature
+        self.humidity = humidity
+        self.battery_level = battery_level
+        self.battery_voltage = battery_voltage
+        self.frame_counter = frame_counter
+        self.rssi = rssi
+        self.distance = distance
+        self.measurement_interval = measurement_interval
+        self.ts_ns = ts_ns
+
+
+    @property
+    def mac_address(self):
+
+        mac = _mac_names.get(self.mac_raw, None)
+        if mac is None:
+            mac = _mac_names[self.mac_raw] = ":".join(f"{b:02X}" for b in self.mac_raw)
+        return mac
 
-        mac = ":".join(f"{b:02X}" for b in data[0:6])
-        temp_raw = int.from_bytes(data[6:8], byteorder="big", signed=True)
-        humidity = data[8]
-        battery = data[9]
-        voltage_raw = int.from_bytes(data[10:12], byteorder="big")
-        frame_counter = data[12]
-
-        temp = temp_raw / 10.0
-        voltage = voltage_raw / 1000.0
-
-        rssi = advertisement_data.rssi
-        distance = estimate_distance(rssi)
-
-        measured_interval = 0
-        last_frame_data = frame_count_dict.get(mac, None)
-        if last_frame_data:
-            last_ts = last_frame_data["ts"]
-            last_frame_counter = last_frame_data["frame_counter"]
-            measured_interval = last_frame_data["measured_interval"]
-            if last_frame_counter != frame_counter:
-                measured_interval = (ts - last_ts).total_seconds()
-                frame_count_dict[mac] = {
-                    "ts": ts,
-                    "frame_counter": frame_counter,
-                    "measured_interval": measured_interval
-                }
-        else:
-            frame_count_dict[mac] = {
-                "ts": ts,
-                "frame_counter": frame_counter,
-                "measured_interval": measured_interval
-            }
+
+    def to_dict(self):
+
+        ts = datetime.fromtimestamp(self.ts_ns / 1e9)
 
         entry = {
             "timestamp": ts.strftime("%Y-%m-%d %H:%M:%S"),
-            "temperature": round(temp, 2), # C or F depending on firmware config
-            "humidity": int(humidity),     # percent
-            "battery_level": float(battery), # percent
-            "battery_voltage": round(voltage, 3), # volt
-            "frame_counter": int(frame_counter),
-            "rssi": int(rssi),
-            "distance": round(distance, 2) or 0.0, # meter
-            "measurement_interval": round(float(measured_interval), 2) # second
+            "temperature": round(self.temperature, 2), # C or F depending on firmware config
+            "humidity": self.humidity,                 # percent
+            "battery_level": float(self.battery_level), # percent
+            "battery_voltage": round(self.battery_voltage, 3), # volt
+            "frame_counter": self.frame_counter,
+            "rssi": self.rssi,
+            "distance": self.distance,                 # meter
+            "measurement_interval": round(self.measurement_interval, 2) # second
         }
 
-        sensor_entry = sensors_dict.get(mac, {})
-        entry.update(sensor_entry)
+        sensor = registry.lookup_raw(self.mac_raw)
+        if sensor:
+            entry["name"] = sensor.get("name", None)
+            entry["location"] = sensor.get("location", None)
+        entry["mac_address"] = self.mac_address
 
         return entry
 
+
+    def to_payload(self):
+        """
+            Re-pack the reading into its 13-byte custom firmware payload (lossless).
+        """
+
+        return PAYLOAD_STRUCT.pack(self.mac_raw,
+                                   round(self.temperature * 10),
+                                   self.humidity,
+                                   self.battery_level,
+                                   round(self.battery_voltage * 1000),
+                                   self.frame_counter)
+
+
+def decode_payload(data, rssi, ts_ns=None):
+    """
+        Decodes the custom advertisement payload into a SensorReading.
+        'ts_ns' is the reception time in nanoseconds since the epoch (defaults to now).
+    """
+
+    if len(data) < 13:
+        return None  # Payload too short to parse
+
+    if ts_ns is None:
+        ts_ns = time.time_ns()
+
+    mac_raw, temp_raw, humidity, battery, voltage_raw, frame_counter = PAYLOAD_STRUCT.unpack_from(data)
+
+    measured_interval = 0.0
+    last_frame_data = frame_count_dict.get(mac_raw, None)
+    if last_frame_data:
+        measured_interval = last_frame_data[2]
+        if last_frame_data[1] != frame_counter:
+            measured_interval = (ts_ns - last_frame_data[0]) / 1e9
+            last_frame_data[0] = ts_ns
+            last_frame_data[1] = frame_counter
+            last_frame_data[2] = measured_interval
+    else:
+        frame_count_dict[mac_raw] = [ts_ns, frame_counter, measured_interval]
+
+    return SensorReading(mac_raw,
+                         temp_raw / 10.0,
+                         humidity,
+                         battery,
+                         voltage_raw / 1000.0,
+                         frame_counter,
+                         rssi,
+                         DISTANCE_TABLE[rssi & 0xFF],
+                         measured_interval,
+                         ts_ns)
+
+
+def parse_custom_payload(data, advertisement_data, ts_ns=None):
+    """
+        Parses the custom advertisement payload according to the firmware spec.
+        'ts_ns' is the reception time in nanoseconds since the epoch (defaults to now).
+    """
+
+    try:
+        reading = decode_payload(data, int(advertisement_data.rssi), ts_ns)
     except Exception as e:
         print(f"Error parsing payload: {e}")
         return None
 
+    if not reading:
+        return None
+
+    return reading.to_dict()
+
+
+def parse_custom_payloads(payloads, rssi=None):
+    """
+        Vectorized decoder for many custom advertisement payloads at once
+        (e.g., recorded frames for offline analysis or replay).
+
+        'payloads' is either a list of payloads or one buffer of concatenated
+        13-byte payloads; 'rssi' is an optional sequence with one RSSI per payload.
+        Returns a dictionary of NumPy arrays of equal length, one per field. 'mac'
+        holds the 48-bit MAC address as an integer. Payloads shorter than 13 bytes
+        are skipped, along with their RSSI.
+    """
+
+    import numpy as np  # only needed for bulk decoding
+
+    dtype = np.dtype([
+        ("mac", "u1", (6,)),
+        ("temperature", ">i2"),
+        ("humidity", "u1"),
+        ("battery_level", "u1"),
+        ("battery_voltage", ">u2"),
+        ("frame_counter", "u1")
+    ])
+
+    valid = None
+
+    if isinstance(payloads, (bytes, bytearray, memoryview)):
+        buffer = payloads
+        count = len(buffer) // dtype.itemsize
+    else:
+        payloads = list(payloads)
+        count = len(payloads)
+        valid = np.fromiter((len(payload) >= dtype.itemsize for payload in payloads), dtype=bool, count=count)
+        buffer = b"".join(bytes(payload[:dtype.itemsize]) for payload in payloads if len(payload) >= dtype.itemsize)
+
+    if rssi is not None:
+        rssi = np.asarray(rssi, dtype=np.int8)
+        if len(rssi) != count:
+            raise ValueError(f"parse_custom_payloads: {len(rssi)} RSSI values for {count} payloads")
+        if valid is not None:
+            rssi = rssi[valid]
+
+    records = np.frombuffer(buffer, dtype=dtype, count=len(buffer) // dtype.itemsize)
+
+    mac = np.zeros(len(records), dtype=np.uint64)
+    for i in range(6):
+        mac = (mac << np.uint64(8)) | records["mac"][:, i].astype(np.uint64)
+
+    columns = {
+        "mac": mac,
+        "temperature": records["temperature"].astype(np.float32) / 10,
+        "humidity": records["humidity"].copy(),
+        "battery_level": records["battery_level"].copy(),
+        "battery_voltage": records["battery_voltage"].astype(np.float32) / 1000,
+        "frame_counter": records["frame_counter"].copy()
+    }
+
+    if rssi is not None:
+        columns["rssi"] = rssi
+        columns["distance"] = estimate_distances(rssi)
+
+    return columns
+
+
+def estimate_distances(rssi):
+    """
+        Vectorized estimate_distance() over an array of integer RSSI values.
+    """
+
+    import numpy as np
+
+    return np.asarray(DISTANCE_TABLE, dtype=np.float32)[np.asarray(rssi, dtype=np.int16) & 0xFF]
+
 
 def estimate_distance(rssi, tx_power=-59):
     """
@@ -149,60 +284,309 @@ def estimate_distance(rssi, tx_power=-59):
         return 0.89976 * pow(ratio, 7.7095) + 0.111
 
 
-async def scan():
+# rounded distance for every possible (int8) RSSI, indexed by rssi & 0xFF
+DISTANCE_TABLE = [round(estimate_distance(rssi - 256 if rssi > 127 else rssi) or 0.0, 2)
+                  for rssi in range(256)]
+
+
+async def scan(queue_size=1024,
+               queue_policy=frame_queue.DROP_OLDEST,
+               consumers=1,
+               scanner_cls=BleakScanner,
+               capture_path=None):
     """
         Start scanning for BLE advertisements.
-        Parsed sensor data is passed to all registered callbacks.
+
+        The detection callback only filters and enqueues raw frames onto a bounded
+        queue; 'consumers' tasks decode them and pass the parsed sensor data to all
+        registered callbacks, so slow callbacks never hold up the scanner.
+        'queue_policy' is one of frame_queue.POLICIES.
+
+        'scanner_cls' is called with the detection callback and must return an
+        object with async start()/stop(), like BleakScanner (e.g., a
+        ble_capture.ReplayScanner). If 'capture_path' is given, every frame
+        delivered by the scanner is appended to that capture file.
     """
 
+    global _frame_queue
+
+    def forget_frame(frame):
+        # evicted before it was decoded: let the next repeat of that frame through
+        mac_int, payload = frame[:2]
+        last_frame = last_frame_dict.get(mac_int, None)
+        if last_frame and last_frame[0] == payload:
+            del last_frame_dict[mac_int]
+
+    _frame_queue = FrameQueue(maxsize=queue_size, policy=queue_policy, on_drop=forget_frame)
+
+    capture = CaptureWriter(capture_path) if capture_path else None
+
     def detection_callback(device, advertisement_data):
 
-        if device.address.upper() not in sensors_mac_address:
-            return  # Ignore other devices
+        _scan_stats["advertisements"] += 1
+
+        if capture:
+            for uuid, payload in advertisement_data.service_data.items():
+                capture.record(device.address, advertisement_data.rssi, uuid, payload)
+
+        mac_int = registry.match(device.address)
+        if mac_int is None:
+            if registry.auto_register:
+                mac_int = auto_register(device.address, advertisement_data)
+            if mac_int is None:
+                _scan_stats["unknown_device"] += 1
+                return  # Ignore other devices
 
         service_data = advertisement_data.service_data
+        sensor_data = False
 
         for uuid, payload in service_data.items():
 
             if not uuid.lower().startswith(UUID_ENV_SENSING[:8]):
                 continue
 
-            parsed = parse_custom_payload(payload, advertisement_data)
-            if not parsed:
+            sensor_data = True
+
+            # sensors re-advertise the same frame every 1-2 seconds;
+            # only a changed payload is worth decoding
+            last_frame = last_frame_dict.get(mac_int, None)
+            if last_frame and last_frame[0] == payload:
+                last_frame[1] += 1
+                last_frame[2] = advertisement_data.rssi
+                _scan_stats["repeats"] += 1
                 continue
 
-            # Notify all registered callbacks
-            for callback in _data_callbacks:
-                callback(parsed)
+            if _frame_queue.put_nowait((mac_int, payload, advertisement_data.rssi, time.time_ns())):
+                last_frame_dict[mac_int] = [payload, 0, advertisement_data.rssi]
+
+        if not sensor_data:
+            _scan_stats["not_sensor_data"] += 1
+
+    # reload the sensor file on SIGHUP (not available on every platform/thread)
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGHUP, registry.reload)
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        pass
 
     print(f"Listening for passive data...")
-    scanner = BleakScanner(detection_callback)
+    if profiler:
+        detection_callback = profiler.wrap("detect", detection_callback)
+
+    scanner = scanner_cls(detection_callback)
     await scanner.start()
 
+    tasks = [asyncio.create_task(consume_frames(_frame_queue)) for _ in range(consumers)]
+
     try:
         while True:
             await asyncio.sleep(5)
+            registry.reload_if_changed()
     except (asyncio.CancelledError, KeyboardInterrupt):
         print("\nScan stopped. Cleaning up BLE scanner...")
     finally:
         await scanner.stop()
+        try:
+            loop.remove_signal_handler(signal.SIGHUP)
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            pass
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if capture:
+            print(f"Captured {capture.frames} frames to {capture_path}")
+            capture.close()
+
+
+def auto_register(address, advertisement_data):
+    """
+        Register an unknown device if it broadcasts custom firmware 0x181A data
+        (the payload starts with the device's own MAC address).
+        Returns its MAC (int), or None.
+    """
+
+    for uuid, payload in advertisement_data.service_data.items():
+
+        if not uuid.lower().startswith(UUID_ENV_SENSING[:8]) or len(payload) < PAYLOAD_STRUCT.size:
+            continue
+
+        if payload[:6].hex(":").upper() == address.upper():
+            return registry.register_unknown(address)
+
+    return None
 
 
-def register_callback(callback):
+async def consume_frames(queue):
+    """
+        Decode frames from the queue and notify all registered callbacks.
+    """
+
+    while True:
+
+        mac_int, payload, rssi, ts_ns = await queue.get()
+
+        try:
+            if profiler and profiler.enabled:
+                frame = profiler.begin_frame(mac_int, ts_ns)
+                try:
+                    await process_frame(payload, rssi, ts_ns)
+                finally:
+                    profiler.end_frame(frame)
+            else:
+                await process_frame(payload, rssi, ts_ns)
+        finally:
+            queue.task_done()
+
+
+async def process_frame(payload, rssi, ts_ns):
+
+    try:
+        if decode_latency or (profiler and profiler.enabled):
+            start = time.perf_counter_ns()
+            reading = decode_payload(payload, rssi, ts_ns)
+            elapsed = time.perf_counter_ns() - start
+            if decode_latency:
+                decode_latency.observe(elapsed / 1e9)
+            if profiler and profiler.enabled:
+                profiler.stage("decode", elapsed)
+        else:
+            reading = decode_payload(payload, rssi, ts_ns)
+    except Exception as e:
+        _scan_stats["decode_errors"] += 1
+        print(f"Error parsing payload: {e}")
+        return
+
+    if not reading:
+        _scan_stats["decode_errors"] += 1
+        return
+
+    _scan_stats["decoded"] += 1
+
+    # Notify all registered callbacks
+    for callback, blocking, raw in _data_callbacks:
+        data = reading if raw else reading.to_dict()
+        try:
+            if asyncio.iscoroutinefunction(callback):
+                await callback(data)
+            elif blocking:
+                await asyncio.to_thread(callback, data)
+            else:
+                callback(data)
+        except Exception as e:
+            print(f"Error in data callback: {e}")
+
+
+def register_callback(callback, blocking=True, raw=False):
     """
         Register a callback to receive parsed sensor data.
-        The callback should accept one argument (the parsed dictionary).
+        The callback should accept one argument (the parsed dictionary, or
+        the SensorReading itself if 'raw' is True).
+        Coroutine functions are awaited. Other callbacks run in a worker thread,
+        unless 'blocking' is False, in which case they must be quick as they
+        run on the event loop.
+    """
+
+    _data_callbacks.append((callback, blocking, raw))
+
+
+def register_sensors(sensors):
     """
+        Add sensor entries (name, location, mac_address) to the set of sensors
+        the scanner listens to, e.g., for a simulated fleet.
+    """
+
+    registry.add(sensors)
+
+
+def queue_stats():
+    """
+        Return frame queue counters (depth, enqueued, dropped, ...) of the running scan.
+    """
+
+    if not _frame_queue:
+        return {}
+
+    return {"depth": _frame_queue.depth(), **_frame_queue.stats}
+
 
-    _data_callbacks.append(callback)
+def scan_stats():
+    """
+        Return hot path counters: advertisements delivered by the scanner, filtered
+        (unknown device, no sensor data, repeated frame), decoded and failed to decode.
+    """
+
+    return dict(_scan_stats)
+
+
+def last_seen():
+    """
+        Return, per sensor MAC (raw bytes), the reception time (ns) of its last new frame.
+    """
+
+    return {mac_raw: frame_data[0] for mac_raw, frame_data in frame_count_dict.items()}
+
+
+def repeat_stats():
+    """
+        Return, per sensor MAC, how many repeated advertisements of the current
+        frame were skipped without decoding and the last RSSI they were heard at.
+    """
+
+    return {
+        int_to_mac(mac_int): {"repeats": last_frame[1], "rssi": last_frame[2]}
+        for mac_int, last_frame in last_frame_dict.items()
+    }
 
 
 if __name__ == "__main__":
 
+    import argparse
+    from ble_capture import ReplayScanner
+
+    parser = argparse.ArgumentParser(description="Passively collect BLE sensor advertisements.")
+    parser.add_argument("--capture", metavar="FILE", help="append every received frame to a capture file")
+    parser.add_argument("--replay", metavar="FILE", help="replay a capture file instead of scanning")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed (0 = as fast as possible)")
+    parser.add_argument("--auto-register", action="store_true", help="pick up unknown devices broadcasting 0x181A")
+    args = parser.parse_args()
+
+    registry.auto_register = args.auto_register
+
     def print_sensor_data(data):
         print(f"\n[+] Received Data:")
         for key, value in data.items():
             print(f"      {key}: {value}")
 
-    register_callback(print_sensor_data)
-    asyncio.run(scan())
+    async def replay():
+
+        replay_scanner = None
+        scanner_ready = asyncio.Event()
+
+        def make_scanner(detection_callback):
+            nonlocal replay_scanner
+            replay_scanner = ReplayScanner(detection_callback, path=args.replay, speed=args.speed or None)
+            scanner_ready.set()
+            return replay_scanner
+
+        task = asyncio.create_task(scan(scanner_cls=make_scanner, capture_path=args.capture))
+
+        async def until(awaitable):
+            # wait for 'awaitable', unless scan() ends first; returns False in that case
+            waiter = asyncio.ensure_future(awaitable)
+            await asyncio.wait([waiter, task], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            return not task.done()
+
+        # replay ends once the file is read and the consumers processed every queued frame
+        if await until(scanner_ready.wait()) and await until(replay_scanner.finished.wait()):
+            await until(_frame_queue.join())
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    register_callback(print_sensor_data, blocking=False)
+
+    if args.replay:
+        asyncio.run(replay())
+    else:
+        asyncio.run(scan(capture_path=args.capture))
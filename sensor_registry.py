@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import os
+import csv
+import time
+import logging
+import tomllib
+
+log = logging.getLogger(__name__)
+
+
+def mac_to_int(mac_address):
+
+    return int(mac_address.replace(":", "").replace("-", ""), 16)
+
+
+def int_to_mac(mac_int):
+
+    return ":".join(f"{b:02X}" for b in mac_int.to_bytes(6, "big"))
+
+
+def read_sensor_file(path):
+    """
+        Read sensor entries (name, location, mac_address, ...) from a TOML, YAML or CSV file.
+
+        TOML/YAML: a list of tables under 'sensor' (or 'sensors'), e.g.
+
+            [[sensor]]
+            name = "sensor1"
+            location = "bedroom"
+            mac_address = "A4:C1:38:AA:EA:0D"
+
+        CSV: a header row with at least name, location and mac_address.
+    """
+
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == ".toml":
+        with open(path, "rb") as f:
+            content = tomllib.load(f)
+    elif ext in (".yaml", ".yml"):
+        import yaml  # optional, only needed for YAML sensor files
+        with open(path, "r") as f:
+            content = yaml.safe_load(f) or {}
+    elif ext == ".csv":
+        with open(path, "r", newline="") as f:
+            return [dict(row) for row in csv.DictReader(f)]
+    else:
+        raise ValueError(f"unsupported sensor file type '{ext}' (toml, yaml or csv)")
+
+    if isinstance(content, list):
+        return content
+
+    return content.get("sensor", content.get("sensors", []))
+
+
+class SensorRegistry():
+    """
+        Sensors the collector listens to, indexed by their 48-bit MAC address as an integer.
+
+        The registry is loaded from a sensor file and can be reloaded while the
+        scanner runs (reload() on SIGHUP, reload_if_changed() on file change); a
+        reload swaps in a fully built index, so lookups never see a half-loaded state.
+        With 'auto_register', unknown devices broadcasting 0x181A sensor data are
+        added on the fly.
+    """
+
+    # bound on the address string cache (phones rotate random addresses)
+    MAX_ADDRESS_CACHE = 10_000
+
+    def __init__(self, path=None, auto_register=False, check_interval=5.0):
+
+        self.path = path
+        self.auto_register = auto_register
+        self.check_interval = check_interval
+        self.mtime = None
+        self.next_check = 0.0
+
+        # mac (int) -> sensor entry
+        self.by_mac = {}
+
+        # address string as reported by the scanner -> mac (int), or None if not a sensor
+        self.address_cache = {}
+
+        if path:
+            self.reload()
+
+
+    def __len__(self):
+
+        return len(self.by_mac)
+
+
+    def sensors(self):
+
+        return list(self.by_mac.values())
+
+
+    def reload(self):
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+            entries = read_sensor_file(self.path)
+            by_mac = self.__index(entries)
+        except Exception as E:
+            log.error("SensorRegistry: cannot load %s: %s", self.path, E)
+            return False, str(E)
+
+        # keep sensors that were added at runtime (auto-registered, simulated, ...)
+        for mac_int, sensor in self.by_mac.items():
+            if sensor.get("runtime", False) and mac_int not in by_mac:
+                by_mac[mac_int] = sensor
+
+        self.by_mac = by_mac
+        self.address_cache = {}
+        self.mtime = mtime
+
+        log.info("SensorRegistry: loaded %d sensors from %s", len(by_mac), self.path)
+        return True, None
+
+
+    def reload_if_changed(self):
+
+        if not self.path:
+            return False
+
+        now = time.monotonic()
+        if now < self.next_check:
+            return False
+        self.next_check = now + self.check_interval
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+
+        if mtime == self.mtime:
+            return False
+
+        status, _ = self.reload()
+        return status
+
+
+    def add(self, sensors, runtime=True):
+        """
+            Add sensor entries at runtime; they survive reloads of the sensor file.
+        """
+
+        by_mac = dict(self.by_mac)
+        for mac_int, sensor in self.__index(sensors).items():
+            if runtime:
+                sensor["runtime"] = True
+            by_mac[mac_int] = sensor
+
+        self.by_mac = by_mac
+        self.address_cache = {}
+
+
+    def match(self, address):
+        """
+            Map the scanner's address string to the sensor MAC (int), or None if
+            it is not a registered sensor. One dict lookup for addresses seen before.
+        """
+
+        try:
+            return self.address_cache[address]
+        except KeyError:
+            pass
+
+        try:
+            mac_int = mac_to_int(address)
+        except ValueError:
+            mac_int = None
+
+        if mac_int not in self.by_mac:
+            mac_int = None
+
+        if len(self.address_cache) >= self.MAX_ADDRESS_CACHE:
+            self.address_cache = {}
+        self.address_cache[address] = mac_int
+
+        return mac_int
+
+
+    def register_unknown(self, address):
+        """
+            Auto-register a device that broadcasts sensor data (if enabled).
+            Returns its MAC (int), or None.
+        """
+
+        if not self.auto_register:
+            return None
+
+        try:
+            mac_int = mac_to_int(address)
+        except ValueError:
+            return None
+
+        mac_address = int_to_mac(mac_int)
+        self.add([{
+            "name": f"auto-{mac_address[-8:].replace(':', '')}",
+            "location": "unknown",
+            "mac_address": mac_address
+        }])
+
+        log.info("SensorRegistry: auto-registered %s", mac_address)
+        return mac_int
+
+
+    def lookup(self, mac_int):
+
+        return self.by_mac.get(mac_int, None)
+
+
+    def lookup_raw(self, mac_raw):
+
+        return self.by_mac.get(int.from_bytes(mac_raw, "big"), None)
+
+
+    @staticmethod
+    def __index(entries):
+
+        by_mac = {}
+
+        for entry in entries:
+            sensor = dict(entry)
+            mac_int = mac_to_int(sensor["mac_address"])
+            sensor["mac_address"] = int_to_mac(mac_int)
+            by_mac[mac_int] = sensor
+
+        return by_mac
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import time
+import heapq
+import random
+import asyncio
+
+import sensor_collector
+from ble_capture import ReplayDevice, ReplayAdvertisement
+
+
+class SimulatedSensor():
+
+    __slots__ = ("address", "mac_raw", "temperature", "humidity", "battery",
+                 "voltage", "frame_counter", "next_measurement", "payload")
+
+    def __init__(self, address, frame_counter, rng):
+
+        self.address = address
+        self.mac_raw = bytes.fromhex(address.replace(":", ""))
+        self.temperature = rng.uniform(15.0, 28.0)
+        self.humidity = rng.uniform(30.0, 60.0)
+        self.battery = rng.randint(40, 100)
+        self.voltage = 2.5 + self.battery / 100
+        self.frame_counter = frame_counter
+        self.next_measurement = 0.0
+        self.payload = None
+
+
+class SimulatedScanner():
+    """
+        Drop-in stand-in for BleakScanner that generates LYWSD03MMC-style (custom
+        firmware, 0x181A) advertisements for a fleet of virtual sensors.
+
+        Every sensor re-advertises its current frame every 'advert_interval'
+        seconds (+/- 'advert_jitter') and takes a new measurement, bumping its
+        8-bit frame counter, every 'measurement_interval' seconds. RSSI is drawn
+        from a normal distribution (clamped to int8), 'packet_loss' is the
+        probability that an advertisement is never heard, and 'time_scale'
+        speeds up simulated time (10 = ten times faster than real sensors).
+    """
+
+    def __init__(self,
+                 detection_callback,
+                 sensors=1000,
+                 advert_interval=1.5,
+                 advert_jitter=0.5,
+                 measurement_interval=60.0,
+                 rssi_mean=-75.0,
+                 rssi_std=8.0,
+                 packet_loss=0.1,
+                 time_scale=1.0,
+                 seed=None):
+
+        self.detection_callback = detection_callback
+        self.advert_interval = advert_interval
+        self.advert_jitter = advert_jitter
+        self.measurement_interval = measurement_interval
+        self.rssi_mean = rssi_mean
+        self.rssi_std = rssi_std
+        self.packet_loss = packet_loss
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self.task = None
+
+        # random start counters, so wraparound shows up early in a run
+        self.sensors = [
+            SimulatedSensor(self.mac_address(index), self.random.randrange(256), self.random)
+            for index in range(sensors)
+        ]
+
+        self.stats = {
+            "advertisements": 0,
+            "lost": 0,
+            "measurements": 0
+        }
+
+
+    @staticmethod
+    def mac_address(index):
+
+        return "A4:C1:38:" + ":".join(f"{b:02X}" for b in index.to_bytes(3, "big"))
+
+
+    def sensors_list(self):
+        """
+            Sensor entries (name, location, mac_address) for sensor_collector.register_sensors().
+        """
+
+        return [
+            {
+                "name": f"sim{index}",
+                "location": "simulated",
+                "mac_address": sensor.address
+            }
+            for index, sensor in enumerate(self.sensors)
+        ]
+
+
+    async def start(self):
+
+        self.task = asyncio.create_task(self.__run())
+
+
+    async def stop(self):
+
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    #############
+
+    async def __run(self):
+
+        start = time.monotonic()
+
+        # (simulated time of next advertisement, sensor index)
+        schedule = [(self.random.uniform(0, self.advert_interval), index) for index in range(len(self.sensors))]
+        heapq.heapify(schedule)
+
+        while True:
+
+            now = (time.monotonic() - start) * self.time_scale
+
+            # emit everything that is due, then sleep until the next advertisement
+            while schedule[0][0] <= now:
+                ts, index = schedule[0]
+                self.__advertise(self.sensors[index], ts)
+                interval = self.advert_interval + self.random.uniform(-self.advert_jitter, self.advert_jitter)
+                heapq.heapreplace(schedule, (ts + max(0.01, interval), index))
+
+            await asyncio.sleep((schedule[0][0] - now) / self.time_scale)
+
+
+    def __advertise(self, sensor, ts):
+
+        if ts >= sensor.next_measurement:
+            self.__measure(sensor)
+            sensor.next_measurement = ts + self.measurement_interval
+
+        self.stats["advertisements"] += 1
+
+        if self.random.random() < self.packet_loss:
+            self.stats["lost"] += 1
+            return
+
+        rssi = int(self.random.gauss(self.rssi_mean, self.rssi_std))
+        rssi = max(-127, min(-1, rssi))
+
+        self.detection_callback(ReplayDevice(sensor.address),
+                                ReplayAdvertisement(rssi, {sensor_collector.UUID_ENV_SENSING: sensor.payload}))
+
+
+    def __measure(self, sensor):
+
+        sensor.temperature += self.random.gauss(0, 0.1)
+        sensor.humidity = min(100.0, max(0.0, sensor.humidity + self.random.gauss(0, 0.5)))
+        sensor.frame_counter = (sensor.frame_counter + 1) & 0xFF
+
+        sensor.payload = sensor_collector.PAYLOAD_STRUCT.pack(sensor.mac_raw,
+                                                              int(sensor.temperature * 10),
+                                                              int(sensor.humidity),
+                                                              sensor.battery,
+                                                              int(sensor.voltage * 1000),
+                                                              sensor.frame_counter)
+
+        self.stats["measurements"] += 1
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load-test the collector with a simulated sensor fleet.")
+    parser.add_argument("--sensors", type=int, default=1000, help="number of virtual sensors")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="simulated seconds per real second")
+    parser.add_argument("--loss", type=float, default=0.1, help="packet loss probability")
+    parser.add_argument("--duration", type=float, default=30.0, help="run time in seconds")
+    args = parser.parse_args()
+
+    holder = {}
+    readings = [0]
+
+    def make_scanner(detection_callback):
+        holder["scanner"] = SimulatedScanner(detection_callback,
+                                             sensors=args.sensors,
+                                             packet_loss=args.loss,
+                                             time_scale=args.time_scale)
+        sensor_collector.register_sensors(holder["scanner"].sensors_list())
+        return holder["scanner"]
+
+    def count_reading(reading):
+        readings[0] += 1
+
+    async def main():
+        task = asyncio.create_task(sensor_collector.scan(scanner_cls=make_scanner))
+        await asyncio.sleep(args.duration)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    sensor_collector.register_callback(count_reading, blocking=False, raw=True)
+    asyncio.run(main())
+
+    stats = holder["scanner"].stats
+    print(f"\nsensors        : {args.sensors}")
+    print(f"advertisements : {stats['advertisements']} ({stats['advertisements'] / args.duration:,.0f}/s), lost: {stats['lost']}")
+    print(f"measurements   : {stats['measurements']}")
+    print(f"readings       : {readings[0]} ({readings[0] / args.duration:,.0f}/s)")
+    print(f"frame queue    : {sensor_collector.queue_stats()}")
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+
+import zlib
+import struct
+import asyncio
+
+from sensor_collector import PAYLOAD_STRUCT
+
+# Collector to upstream framing, all integers big-endian:
+#
+#   batch header : magic "EW" (2s), version (B), flags (B), record count (H),
+#                  length of the rest of the batch (I), base timestamp in ns (Q)
+#   collector id : length (B) + UTF-8 bytes
+#   records      : 'count' records, zlib-compressed if FLAG_COMPRESSED is set
+#
+#   record       : custom firmware payload (13s, starts with the MAC address),
+#                  reception time in us after the base timestamp (I), RSSI (b)
+#
+# A record is 18 bytes, against ~120 bytes for the same frame as JSON.
+MAGIC = b"EW"
+VERSION = 1
+
+FLAG_COMPRESSED = 0x01
+
+HEADER_STRUCT = struct.Struct(">2sBBHIQ")
+RECORD_STRUCT = struct.Struct(f">{PAYLOAD_STRUCT.size}sIb")
+
+# records per batch (record count is 16-bit); deltas are 32-bit us (~71 minutes)
+MAX_RECORDS = 0xFFFF
+MAX_DELTA_NS = 0xFFFFFFFF * 1000
+
+# largest batch accepted by read_batch(), a guard against garbage on the stream
+MAX_BATCH_SIZE = 4 * 1024 * 1024
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def encode_batch(frames, collector_id, compress=False):
+    """
+        Encode (payload, rssi, ts_ns) frames into one batch. At most MAX_RECORDS
+        frames, received within ~71 minutes of each other; timestamps are kept
+        with microsecond resolution.
+    """
+
+    frames = list(frames)
+    if len(frames) > MAX_RECORDS:
+        raise WireFormatError(f"too many frames for one batch ({len(frames)} > {MAX_RECORDS})")
+
+    base_ts = min((ts_ns for _, _, ts_ns in frames), default=0)
+
+    body = bytearray(RECORD_STRUCT.size * len(frames))
+    offset = 0
+    for payload, rssi, ts_ns in frames:
+        delta_ns = ts_ns - base_ts
+        if delta_ns > MAX_DELTA_NS:
+            raise WireFormatError("frames of one batch span more than the 32-bit timestamp delta")
+        RECORD_STRUCT.pack_into(body, offset, payload, delta_ns // 1000, rssi)
+        offset += RECORD_STRUCT.size
+
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 1)
+        flags |= FLAG_COMPRESSED
+
+    collector = collector_id.encode()
+    if len(collector) > 255:
+        raise WireFormatError("collector id longer than 255 bytes")
+
+    length = 1 + len(collector) + len(body)
+    header = HEADER_STRUCT.pack(MAGIC, VERSION, flags, len(frames), length, base_ts)
+
+    return b"".join((header, bytes((len(collector),)), collector, body))
+
+
+def encode_readings(readings, collector_id, compress=False):
+    """
+        encode_batch() for sensor_collector.SensorReading objects.
+    """
+
+    return encode_batch(((reading.to_payload(), reading.rssi, reading.ts_ns) for reading in readings),
+                        collector_id, compress)
+
+
+def decode_header(data):
+    """
+        Return (flags, record count, length of the rest of the batch, base timestamp).
+    """
+
+    magic, version, flags, count, length, base_ts = HEADER_STRUCT.unpack_from(data)
+
+    if magic != MAGIC:
+        raise WireFormatError("not a batch (bad magic)")
+    if version != VERSION:
+        raise WireFormatError(f"unsupported wire format version {version}")
+
+    return flags, count, length, base_ts
+
+
+def decode_batch(data):
+    """
+        Decode one batch. Returns (collector id, [(payload, rssi, ts_ns), ...]).
+    """
+
+    if len(data) < HEADER_STRUCT.size:
+        raise WireFormatError("truncated batch header")
+
+    flags, count, length, base_ts = decode_header(data)
+
+    if len(data) != HEADER_STRUCT.size + length:
+        raise WireFormatError("batch length does not match its header")
+
+    return decode_body(memoryview(data)[HEADER_STRUCT.size:], flags, count, base_ts)
+
+
+def decode_body(data, flags, count, base_ts):
+
+    if not data:
+        raise WireFormatError("missing collector id")
+
+    collector_len = data[0]
+    collector = bytes(data[1:1 + collector_len]).decode()
+    body = data[1 + collector_len:]
+
+    if flags & FLAG_COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as E:
+            raise WireFormatError(f"corrupt compressed batch: {E}")
+
+    if len(body) != count * RECORD_STRUCT.size:
+        raise WireFormatError("record data does not match the record count")
+
+    frames = [(payload, rssi, base_ts + delta_us * 1000)
+              for payload, delta_us, rssi in RECORD_STRUCT.iter_unpack(body)]
+
+    return collector, frames
+
+
+async def read_batch(reader):
+    """
+        Read and decode the next batch from an asyncio.StreamReader.
+        Returns None at end of stream.
+    """
+
+    try:
+        header = await reader.readexactly(HEADER_STRUCT.size)
+    except asyncio.IncompleteReadError as E:
+        if E.partial:
+            raise WireFormatError("truncated batch header")
+        return None
+
+    flags, count, length, base_ts = decode_header(header)
+
+    if length > MAX_BATCH_SIZE:
+        raise WireFormatError(f"batch too large ({length} bytes)")
+
+    rest = await reader.readexactly(length)
+    return decode_body(memoryview(rest), flags, count, base_ts)